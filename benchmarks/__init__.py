@@ -0,0 +1,5 @@
+"""Benchmarks for the EC262 client libraries
+
+Run each one as a module from the top of the repository, e.g.
+`python -m benchmarks.bench_scheduler`.
+"""
@@ -0,0 +1,127 @@
+"""Benchmark for per-row and batched map and reduce functions
+
+Runs a word count over chunks of lines the way a worker runs a task: the
+functions are frozen, sandboxed and called through `map_chunk` and
+`reduce_chunk`. The per-row functions are called once per line and once per
+word; the batched ones once per chunk, counting in a dictionary or, if it is
+installed, with NumPy. Reports the throughput of the map and the reduce
+phase in rows per second.
+"""
+import time
+import bisect
+import random
+import optparse
+from ec262.engine import map_chunk, reduce_chunk
+from ec262.sandbox import LRUCache, freeze_function, load_function
+from ec262.shuffle import ShuffleBuffer
+import ec262.settings as settings
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def mapfn(key, line):
+    for word in line.split():
+        yield word, 1
+
+def reducefn(key, values):
+    yield key, sum(values)
+
+def batch_mapfn(keys, lines):
+    counts = {}
+    get = counts.get
+    for word in ' '.join(lines).split():
+        counts[word] = get(word, 0) + 1
+    return counts.keys(), counts.values()
+
+def batch_reducefn(keys, values):
+    return keys, [sum(v) for v in values]
+
+# These import numpy themselves, since they run sandboxed without this
+# module's globals
+def numpy_mapfn(keys, lines):
+    import numpy
+    words = numpy.array(' '.join(lines).split())
+    return numpy.unique(words, return_counts=True)
+
+def numpy_reducefn(keys, values):
+    import numpy
+    lengths = numpy.array([len(v) for v in values])
+    flat = numpy.fromiter((n for v in values for n in v), numpy.int64,
+                          lengths.sum())
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    return keys, numpy.add.reduceat(flat, starts)
+
+def make_chunks(rows, chunk_rows, vocabulary, words_per_line):
+    """Chunks of lines of words drawn from a Zipf-like vocabulary"""
+    rng = random.Random(262)
+    words = ["word%d" % i for i in xrange(vocabulary)]
+    weights = [1.0 / (i + 1) for i in xrange(vocabulary)]
+    total = sum(weights)
+    cumulative, running = [], 0.0
+    for weight in weights:
+        running += weight / total
+        cumulative.append(running)
+    def word():
+        return words[min(bisect.bisect(cumulative, rng.random()),
+                         vocabulary - 1)]
+    lines = [(i, ' '.join(word() for j in xrange(words_per_line)))
+             for i in xrange(rows)]
+    return [lines[i:i + chunk_rows] for i in xrange(0, rows, chunk_rows)]
+
+def sandboxed(fn, name):
+    return load_function(LRUCache(1), freeze_function(fn), name,
+                         settings.ALLOWED_MODULES)
+
+def measure(chunks, mapper, reducer, batch):
+    mapper = sandboxed(mapper, 'mapfn')
+    reducer = sandboxed(reducer, 'reducefn')
+    rows = sum(len(chunk) for chunk in chunks)
+    shuffle = ShuffleBuffer()
+    map_time = 0.0
+    for chunk in chunks:
+        start = time.time()
+        output = map_chunk(mapper, None, chunk, batch)
+        map_time += time.time() - start
+        shuffle.update(output)
+    grouped = shuffle.materialize().items()
+    start = time.time()
+    result = {}
+    for i in xrange(0, len(grouped), len(chunks[0])):
+        result.update(reduce_chunk(reducer, grouped[i:i + len(chunks[0])],
+                                   batch))
+    reduce_time = time.time() - start
+    return rows / map_time, len(grouped) / reduce_time, result
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--rows", dest="rows", type="int",
+                      default=200000, help="number of lines")
+    parser.add_option("-c", "--chunk", dest="chunk", type="int",
+                      default=2000, help="rows per chunk")
+    parser.add_option("-v", "--vocabulary", dest="vocabulary", type="int",
+                      default=50000, help="number of distinct words")
+    parser.add_option("-w", "--words", dest="words", type="int",
+                      default=10, help="words per line")
+    (options, args) = parser.parse_args()
+
+    chunks = make_chunks(options.rows, options.chunk, options.vocabulary,
+                         options.words)
+    runs = [("per row", mapfn, reducefn, ()),
+            ("batch", batch_mapfn, batch_reducefn, ('mapfn', 'reducefn'))]
+    if numpy is not None:
+        runs.append(("batch numpy", numpy_mapfn, numpy_reducefn,
+                     ('mapfn', 'reducefn')))
+
+    print "%-12s %14s %14s %9s" % ("functions", "map rows/s",
+                                   "reduce keys/s", "speedup")
+    expected = base = None
+    for name, mapper, reducer, batch in runs:
+        map_rate, reduce_rate, result = measure(chunks, mapper, reducer,
+                                                batch)
+        if expected is None:
+            expected, base = result, map_rate
+        elif result != expected:
+            print "%s gave a different result" % (name,)
+        print "%-12s %14.0f %14.0f %8.1fx" % (name, map_rate, reduce_rate,
+                                              map_rate / base)
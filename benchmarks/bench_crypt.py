@@ -0,0 +1,85 @@
+"""Benchmark for encrypting and decrypting results
+
+Encrypts result sets of different sizes the way discovery.py used to (the
+whole result serialized, padded, encrypted and Base64-encoded in memory)
+and with the streaming pipeline, for both canonical encodings. Reports the
+throughput in MB of serialized data per second and how much the peak RSS
+grew over that of the result set itself. Each measurement runs in its own
+process so that peaks don't carry over.
+"""
+import os
+import json
+import time
+import optparse
+import multiprocessing
+from base64 import b64decode, b64encode
+from Crypto.Cipher import AES
+import ec262.discovery as discovery
+from benchmarks.cluster import peak_rss
+
+ROW_BYTES = 128
+
+def make_data(megabytes):
+    """A result set that serializes to about `megabytes` MB of JSON"""
+    rows = megabytes * 2 ** 20 / ROW_BYTES
+    value = 'x' * (ROW_BYTES - 48)
+    return dict(("key%012d" % i, [value, i, i * 0.5]) for i in xrange(rows))
+
+def cipher(key):
+    return AES.new(key, AES.MODE_CBC, '\0' * AES.block_size)
+
+def inmemory_encrypt(data, key):
+    """How discovery._crypt_data encrypted results before streaming"""
+    list_data = list(data.iteritems())
+    list_data.sort(key=lambda x: x[0])
+    json_str = json.dumps(list_data)
+    json_str += " " * (16 - len(json_str) % 16)
+    return b64encode(cipher(key).encrypt(json_str))
+
+def inmemory_decrypt(data, key):
+    return dict(json.loads(cipher(key).decrypt(b64decode(data))))
+
+def measure(megabytes, method, roundtrip, results):
+    data = make_data(megabytes)
+    key = os.urandom(16)
+    before = peak_rss()
+    start = time.time()
+    if method == 'in memory':
+        encrypted = inmemory_encrypt(data, key)
+        if roundtrip:
+            inmemory_decrypt(encrypted, key)
+    else:
+        pieces = discovery._encrypt_stream(data, key, method)
+        if roundtrip:
+            discovery._decrypt_stream(pieces, key, method)
+        else:
+            for piece in pieces:
+                pass
+    results.put((time.time() - start, peak_rss() - before))
+
+def run(megabytes, method, roundtrip):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure,
+                                      args=(megabytes, method, roundtrip,
+                                            results))
+    process.start()
+    outcome = results.get()
+    process.join()
+    return outcome
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--sizes", dest="sizes", default="10,100",
+                      help="comma-separated result sizes in MB, e.g. "
+                           "10,100,1000 (1 GB needs several GB of memory)")
+    (options, args) = parser.parse_args()
+
+    print "%8s %-10s %-10s %10s %14s" % ("MB", "method", "operation",
+                                         "MB/s", "peak RSS +MB")
+    for megabytes in [int(s) for s in options.sizes.split(',')]:
+        for method in ('in memory', 'json', 'binary'):
+            for roundtrip in (False, True):
+                elapsed, rss = run(megabytes, method, roundtrip)
+                print "%8d %-10s %-10s %10.1f %14.1f" % (
+                    megabytes, method, "round trip" if roundtrip else "encrypt",
+                    megabytes / elapsed, rss)
@@ -0,0 +1,92 @@
+"""Benchmark for the event loop with many connections
+
+Opens N loopback connections that each exchange M ping/pong messages, all
+at once, and reports the messages per second for each way of waiting on
+sockets. select() can't handle file descriptors above FD_SETSIZE (usually
+1024), so it fails with larger fan-outs.
+"""
+import time
+import socket
+import asyncore
+import optparse
+import cPickle as pickle
+from ec262 import eventloop
+from ec262.protocol import Protocol
+
+WIRE = {'pickle_protocol': pickle.HIGHEST_PROTOCOL}
+
+class Echo(Protocol):
+    def __init__(self, conn):
+        Protocol.__init__(self, conn)
+        self.set_wire_format(**WIRE)
+        self.register_command('ping', lambda command, data: self.send_command('pong', data))
+
+class Pinger(Protocol):
+    def __init__(self, address, messages):
+        Protocol.__init__(self)
+        self.set_wire_format(**WIRE)
+        self.messages = messages
+        self.register_command('pong', self.pong)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def handle_connect(self):
+        self.send_command('ping', self.messages)
+
+    def pong(self, command, data):
+        self.messages -= 1
+        if self.messages:
+            self.send_command('ping', self.messages)
+        else:
+            self.handle_close()
+
+class Listener(asyncore.dispatcher):
+    def __init__(self, connections):
+        asyncore.dispatcher.__init__(self)
+        self.connections = connections
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(("127.0.0.1", 0))
+        self.listen(connections)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Echo(pair[0])
+            self.connections -= 1
+            if not self.connections:
+                self.close()
+
+def fan_out(poller, connections, messages):
+    """Return messages per second, or None if `poller` can't cope"""
+    listener = Listener(connections)
+    address = listener.getsockname()
+    start = time.time()
+    for i in xrange(connections):
+        Pinger(address, messages)
+    try:
+        eventloop.loop(timeout=1.0, poller=poller)
+    except ValueError:
+        asyncore.close_all()
+        return None
+    return 2 * connections * messages / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--max-connections", dest="max_connections",
+                      type="int", default=4000, help="largest fan-out")
+    parser.add_option("-m", "--messages", dest="messages", type="int",
+                      default=20, help="round trips per connection")
+    (options, args) = parser.parse_args()
+
+    pollers = ('select', 'poll', 'epoll')
+    print "%12s" % "connections" + "".join("%12s" % p for p in pollers),
+    print "  (messages/s)"
+    connections = 125
+    while connections <= options.max_connections:
+        row = "%12d" % connections
+        for poller in pollers:
+            rate = fan_out(poller, connections, options.messages)
+            row += "%12s" % ("n/a" if rate is None else "%.0f" % rate)
+        print row
+        connections *= 2
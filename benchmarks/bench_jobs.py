@@ -0,0 +1,165 @@
+"""End-to-end benchmark of whole jobs on a local cluster
+
+Starts a LocalCluster of workers on loopback and runs standard workloads
+on it through the foreman:
+
+    wordcount   word count over lines of Zipf-distributed words, like a
+                novel, with a combiner (or the lines of --text)
+    skewed      half of the map output has the same key, without combiner
+    large       rows with large values that go through the shuffle as is
+    tiny        many tiny rows with a combiner
+
+Prints a JSON list with, for each workload, the job's wall time, tasks per
+second, bytes sent to and received from the workers, the foreman's peak
+RSS, how long each phase took and the time tasks spent in each span (see
+ec262.tracing), so results can be kept and compared between versions.
+Each job runs in its own foreman process so that peaks don't carry over.
+"""
+import sys
+import json
+import bisect
+import random
+import optparse
+import multiprocessing
+from ec262 import LineFileSource
+from ec262.foreman import Foreman
+import ec262.settings as settings
+from benchmarks.cluster import LocalCluster, peak_rss
+
+def count_words(key, line):
+    for word in line.split():
+        yield word, 1
+
+def skewed_map(key, value):
+    yield value, 1
+
+def identity_map(key, value):
+    yield key, value
+
+def tiny_map(key, value):
+    yield value % 1000, 1
+
+def total(key, values):
+    yield key, sum(values)
+
+def largest(key, values):
+    yield key, max(len(value) for value in values)
+
+def zipf_words(vocabulary, rng):
+    """A function that draws words with Zipf-distributed frequencies"""
+    words = ["word%d" % i for i in xrange(vocabulary)]
+    cumulative, running = [], 0.0
+    norm = sum(1.0 / (i + 1) for i in xrange(vocabulary))
+    for i in xrange(vocabulary):
+        running += 1.0 / (i + 1) / norm
+        cumulative.append(running)
+    return lambda: words[min(bisect.bisect(cumulative, rng.random()),
+                             vocabulary - 1)]
+
+def wordcount_data(rows, options, rng):
+    if options.text:
+        return LineFileSource(options.text)
+    word = zipf_words(20000, rng)
+    return dict((i, ' '.join(word() for j in xrange(10)))
+                for i in xrange(rows))
+
+def skewed_data(rows, options, rng):
+    return dict((i, "hot" if rng.random() < 0.5 else
+                 "key%d" % rng.randrange(10000)) for i in xrange(rows))
+
+def large_data(rows, options, rng):
+    # Random hex digits, which compression can only halve
+    size = options.value_bytes
+    return dict((i, '%0*x' % (size, rng.getrandbits(4 * size)))
+                for i in xrange(rows / 10))
+
+def tiny_data(rows, options, rng):
+    return dict((i, i) for i in xrange(rows * 10))
+
+# name: (mapfn, reducefn, combinefn, data)
+WORKLOADS = {
+    'wordcount': (count_words, total, total, wordcount_data),
+    'skewed': (skewed_map, total, None, skewed_data),
+    'large': (identity_map, largest, None, large_data),
+    'tiny': (tiny_map, total, total, tiny_data),
+}
+
+def measure(name, workers, options, results):
+    mapfn, reducefn, combinefn, make_data = WORKLOADS[name]
+    data = make_data(options.rows, options, random.Random(262))
+    f = Foreman()
+    f.mapfn, f.reducefn, f.combinefn = mapfn, reducefn, combinefn
+    f.replication = dict(repetitions=options.replicas,
+                         quorum=min(options.replicas, settings.QUORUM),
+                         max_repetitions=max(options.replicas,
+                                             settings.MAX_REPLICAS))
+    f.shuffle_mode = options.shuffle
+    f.chunking = dict(adaptive=True, rows=settings.MIN_CHUNK_ROWS,
+                      min_rows=settings.MIN_CHUNK_ROWS,
+                      max_rows=settings.MAX_CHUNK_ROWS,
+                      target_time=settings.CHUNK_TARGET_TIME,
+                      target_bytes=settings.CHUNK_TARGET_BYTES)
+    f.datasource = data
+    before = peak_rss()
+    result = f.run(workers)
+    stats = f.stats
+    results.put(dict(
+        workload=name,
+        workers=len(workers),
+        replicas=options.replicas,
+        shuffle=options.shuffle,
+        keys=len(result or ()),
+        wall_time=stats['elapsed'],
+        tasks=stats['tasks'],
+        tasks_per_second=stats['tasks'] / stats['elapsed'],
+        bytes_sent=stats['bytes_sent'],
+        bytes_received=stats['bytes_received'],
+        foreman_peak_rss_mb=peak_rss(),
+        foreman_rss_growth_mb=peak_rss() - before,
+        phases=stats['phases'],
+        spans=stats['spans']))
+
+def run(name, workers, options):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure,
+                                      args=(name, workers, options, results))
+    process.start()
+    outcome = results.get()
+    process.join()
+    return outcome
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=3, help="number of workers")
+    parser.add_option("-j", "--processes", dest="processes", type="int",
+                      default=1, help="processes per worker")
+    parser.add_option("-n", "--rows", dest="rows", type="int",
+                      default=20000, help="rows of the wordcount and skewed "
+                      "workloads; large has a tenth and tiny ten times as "
+                      "many")
+    parser.add_option("-l", "--workloads", dest="workloads",
+                      default="wordcount,skewed,large,tiny",
+                      help="comma-separated workloads to run")
+    parser.add_option("-r", "--replicas", dest="replicas", type="int",
+                      default=settings.REPLICAS,
+                      help="replicas of each task")
+    parser.add_option("-s", "--shuffle", dest="shuffle", default="foreman",
+                      help="'foreman' or 'workers'")
+    parser.add_option("-b", "--value-bytes", dest="value_bytes", type="int",
+                      default=64 * 1024, help="size of the large values")
+    parser.add_option("-t", "--text", dest="text", default=None,
+                      help="file to count the words of instead")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="file to write the JSON to instead of stdout")
+    (options, args) = parser.parse_args()
+
+    names = options.workloads.split(',')
+    for name in names:
+        if name not in WORKLOADS:
+            parser.error("Unknown workload: %s" % (name,))
+    with LocalCluster(options.workers, options.processes) as cluster:
+        outcomes = [run(name, cluster.workers, options) for name in names]
+    out = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(outcomes, out, indent=2, sort_keys=True)
+    out.write('\n')
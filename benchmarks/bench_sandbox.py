@@ -0,0 +1,45 @@
+"""Benchmark for imports inside sandboxed functions
+
+Calls a map function that imports a module on every call, as the ones in
+example.py do, and the same function calling a builtin instead of the
+module's function, both frozen and sandboxed the way a worker loads them
+and both unsandboxed. Reports the calls per second of each and what the
+import costs per call.
+"""
+import time
+import optparse
+from ec262.sandbox import LRUCache, freeze_function, load_function
+import ec262.settings as settings
+
+def plain_mapfn(key, value):
+    return [(value, bool(value))]
+
+def importing_mapfn(key, value):
+    import operator
+    return [(value, operator.truth(value))]
+
+def sandboxed(fn, name):
+    return load_function(LRUCache(1), freeze_function(fn), name,
+                         settings.ALLOWED_MODULES)
+
+def measure(fn, calls):
+    start = time.time()
+    for i in xrange(calls):
+        fn(i, 'word')
+    return calls / (time.time() - start)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--calls", dest="calls", type="int",
+                      default=1000000, help="calls of each function")
+    (options, args) = parser.parse_args()
+
+    print "%-12s %16s %16s %14s" % ("function", "without import/s",
+                                    "with import/s", "import cost")
+    for name, wrap in [("plain", lambda fn, name: fn),
+                       ("sandboxed", sandboxed)]:
+        without = measure(wrap(plain_mapfn, 'mapfn'), options.calls)
+        with_import = measure(wrap(importing_mapfn, 'mapfn'), options.calls)
+        cost = 1.0 / with_import - 1.0 / without
+        print "%-12s %16.0f %16.0f %12.0fns" % (name, without, with_import,
+                                                cost * 1e9)
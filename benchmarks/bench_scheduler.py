@@ -0,0 +1,63 @@
+"""Microbenchmark for task dispatch
+
+Drives a Job through its whole life cycle (hand out a task, assign it to a
+worker, complete it) with workers that do nothing, and reports the average
+cost of one dispatch. Tasks have a single replica, so the scheduler hands
+out the first waiting task and the cost should stay flat as the number of
+tasks grows. With replicas or spot checks, a dispatch also skips the
+waiting tasks the worker can't run, which this doesn't measure.
+"""
+import time
+import optparse
+from ec262.task import Job, CommandTask
+
+class NullWorker(object):
+    """Stands in for a WorkerController without a connection"""
+    def send_task(self, task):
+        pass
+
+    def cancel_task(self, task):
+        pass
+
+def dispatch(num_tasks, num_workers):
+    """Run `num_tasks` single-row tasks; return seconds per dispatch"""
+    data = dict((i, i) for i in xrange(num_tasks))
+    job = Job(data, CommandTask, command='map')
+    workers = [NullWorker() for i in xrange(num_workers)]
+    dispatched = 0
+    start = time.time()
+    while True:
+        # Every worker picks up a task, then they all complete
+        running = []
+        for worker in workers:
+            try:
+                task = job.next(worker)
+            except StopIteration:
+                break
+            if task is None:
+                break
+            task.add_worker(worker)
+            running.append((task, worker))
+        if not running:
+            break
+        for task, worker in running:
+            task.complete(worker, {})
+        dispatched += len(running)
+    elapsed = time.time() - start
+    assert dispatched == num_tasks
+    return elapsed / dispatched
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--max-tasks", dest="max_tasks", type="int",
+                      default=1000000, help="largest number of tasks")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=16, help="number of workers")
+    (options, args) = parser.parse_args()
+
+    print "%10s %16s" % ("tasks", "us/dispatch")
+    num_tasks = 1000
+    while num_tasks <= options.max_tasks:
+        cost = dispatch(num_tasks, options.workers)
+        print "%10d %16.2f" % (num_tasks, cost * 1e6)
+        num_tasks *= 10
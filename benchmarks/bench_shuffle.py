@@ -0,0 +1,77 @@
+"""Benchmark for grouping map output on skewed key distributions
+
+Compares the old tuple concatenation with ShuffleBuffer, both for a worker
+grouping the pairs emitted by a mapper and for the foreman merging the
+grouped output of many map tasks. Keys follow a Zipf-like distribution, so
+a few keys (like "the" in a word count) account for most of the values.
+"""
+import time
+import random
+import optparse
+from ec262.shuffle import ShuffleBuffer
+
+def skewed_pairs(num_pairs, num_keys, skew):
+    """Return (key, 1) pairs whose keys follow a power law with exponent `skew`"""
+    rng = random.Random(262)
+    return [(int(rng.paretovariate(skew)) % num_keys, 1)
+            for i in xrange(num_pairs)]
+
+def group_tuples(pairs):
+    results = {}
+    for key, value in pairs:
+        if key not in results:
+            results[key] = ()
+        results[key] += (value,)
+    return results
+
+def group_buffer(pairs):
+    results = ShuffleBuffer()
+    for key, value in pairs:
+        results.add(key, value)
+    return results.materialize()
+
+def merge_tuples(chunks):
+    output = {}
+    for data in chunks:
+        for key, values in data.iteritems():
+            if key not in output:
+                output[key] = ()
+            output[key] += values
+    return output
+
+def merge_buffer(chunks):
+    output = ShuffleBuffer()
+    for data in chunks:
+        output.update(data)
+    return output.materialize()
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--pairs", dest="pairs", type="int",
+                      default=200000, help="number of emitted pairs")
+    parser.add_option("-k", "--keys", dest="keys", type="int",
+                      default=10000, help="number of distinct keys")
+    parser.add_option("-c", "--chunk", dest="chunk", type="int",
+                      default=1000, help="pairs per map task")
+    (options, args) = parser.parse_args()
+
+    print "%6s %10s %10s %10s %10s" % ("skew", "group old", "group new",
+                                       "merge old", "merge new")
+    for skew in (0.5, 1.0, 1.5, 2.0):
+        pairs = skewed_pairs(options.pairs, options.keys, skew)
+        group_old, old = timed(group_tuples, pairs)
+        group_new, new = timed(group_buffer, pairs)
+        assert old == new
+        chunks = [group_buffer(pairs[i:i + options.chunk])
+                  for i in xrange(0, len(pairs), options.chunk)]
+        merge_old, old = timed(merge_tuples, chunks)
+        merge_new, new = timed(merge_buffer, chunks)
+        assert old == new
+        print "%6.1f %9.3fs %9.3fs %9.3fs %9.3fs" % (skew, group_old,
+                                                     group_new, merge_old,
+                                                     merge_new)
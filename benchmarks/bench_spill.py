@@ -0,0 +1,77 @@
+"""Benchmark for shuffling map output on the foreman as key cardinality grows
+
+Feeds the output of many simulated map tasks, each a dictionary of distinct
+keys drawn from `keys` possible ones, to a ShuffleBuffer held in memory (as
+the foreman used to before the reduce phase) and to ExternalShuffleBuffers
+with different memory budgets, then reads back every (key, values) pair the
+way the reduce phase does. Reports the throughput in map output pairs per
+second, how much the peak RSS grew, and how many runs were spilled. Each
+measurement runs in its own process so that peaks don't carry over.
+"""
+import time
+import random
+import optparse
+import multiprocessing
+from ec262.shuffle import ShuffleBuffer, ExternalShuffleBuffer
+from benchmarks.cluster import peak_rss
+
+def map_outputs(num_keys, num_tasks, keys_per_task):
+    """Generate the combined output of each map task, like a word count's"""
+    rng = random.Random(262)
+    for i in xrange(num_tasks):
+        yield dict(("word%09d" % rng.randrange(num_keys), (rng.randint(1, 9),))
+                   for j in xrange(keys_per_task))
+
+def measure(num_keys, num_tasks, keys_per_task, budget, results):
+    before = peak_rss()
+    start = time.time()
+    if budget is None:
+        output = ShuffleBuffer()
+    else:
+        output = ExternalShuffleBuffer(budget * 2 ** 20)
+    pairs = 0
+    for data in map_outputs(num_keys, num_tasks, keys_per_task):
+        output.update(data)
+        pairs += len(data)
+    if budget is None:
+        grouped = output.materialize().iteritems()
+    else:
+        grouped = output.iteritems()
+    distinct = sum(1 for key, values in grouped)
+    runs = len(getattr(output, 'runs', ()))
+    elapsed = time.time() - start
+    results.put((pairs / elapsed, peak_rss() - before, runs, distinct))
+
+def run(*args):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure,
+                                      args=args + (results,))
+    process.start()
+    outcome = results.get()
+    process.join()
+    return outcome
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-k", "--keys", dest="keys",
+                      default="10000,100000,1000000",
+                      help="comma-separated numbers of possible keys")
+    parser.add_option("-t", "--tasks", dest="tasks", type="int", default=200,
+                      help="number of map tasks")
+    parser.add_option("-p", "--per-task", dest="per_task", type="int",
+                      default=10000, help="keys in the output of each task")
+    parser.add_option("-b", "--budgets", dest="budgets", default="16,64",
+                      help="comma-separated memory budgets in MB")
+    (options, args) = parser.parse_args()
+
+    budgets = [None] + [int(b) for b in options.budgets.split(',')]
+    print "%10s %10s %-12s %12s %14s %6s" % ("keys", "distinct", "shuffle",
+                                             "pairs/s", "peak RSS +MB",
+                                             "runs")
+    for num_keys in [int(k) for k in options.keys.split(',')]:
+        for budget in budgets:
+            rate, rss, runs, distinct = run(num_keys, options.tasks,
+                                            options.per_task, budget)
+            name = "in memory" if budget is None else "spill %dMB" % budget
+            print "%10d %10d %-12s %12.0f %14.1f %6d" % (
+                num_keys, distinct, name, rate, rss, runs)
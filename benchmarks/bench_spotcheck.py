@@ -0,0 +1,117 @@
+"""Simulation of task verification with cheating workers
+
+Runs a Job with simulated workers, some of which return a wrong result for
+a fraction of their tasks, and reports for each way of verifying tasks:
+
+    overhead    executions per task (1.0 is no verification)
+    wrong       tasks whose accepted result is wrong
+    catch rate  fraction of wrong results returned that were not accepted
+    convicted   cheating workers found to be dishonest
+
+Replication runs every task on several workers; spot checks run most tasks
+once and check a fraction of them, more often for workers that fail checks.
+"""
+import random
+import logging
+import optparse
+import ec262.canonical as canonical
+from ec262.task import Job, VerifiedTask, SpotCheckedTask
+from ec262.trust import TrustLedger
+
+class SimWorker(object):
+    """Stands in for a WorkerController; cheats with probability `cheat`"""
+    def __init__(self, name, cheat, rng):
+        self.name = name
+        self.cheat = cheat
+        self.rng = rng
+        self.pending = []
+        self.executions = 0
+        self.lies = 0
+
+    def send_task(self, task, digest=False):
+        self.pending.append((task, digest))
+        return digest
+
+    def cancel_task(self, task):
+        """Copies of a task still to run when it completes are ignored"""
+        pass
+
+    def run(self):
+        """Complete the tasks sent since the last call"""
+        pending, self.pending = self.pending, []
+        for task, digest in pending:
+            self.executions += 1
+            key, values = task.data[0]
+            result = {key: sum(values)}
+            if self.rng.random() < self.cheat:
+                result = {key: -1}
+                self.lies += 1
+            if digest:
+                task.complete(self, None, 1.0, canonical.digest(result))
+            else:
+                task.complete(self, result, 1.0)
+
+def simulate(TaskClass, options, num_tasks, num_workers, cheaters, cheat,
+             seed):
+    rng = random.Random(seed)
+    workers = [SimWorker(i, cheat if i < cheaters else 0.0, rng)
+               for i in xrange(num_workers)]
+    data = dict((i, range(i, i + 10)) for i in xrange(num_tasks))
+    job = Job(data, TaskClass, command='map', **options)
+    results = []
+    job.merge_results = results.extend
+    while not job.finished:
+        order = list(workers)
+        rng.shuffle(order)
+        for worker in order:
+            try:
+                task = job.next(worker)
+            except StopIteration:
+                break
+            if task is not None:
+                task.add_worker(worker)
+        for worker in order:
+            worker.run()
+    wrong = sum(1 for result in results
+                for key, value in result.iteritems()
+                if value != sum(data[key]))
+    executions = sum(w.executions for w in workers)
+    lies = sum(w.lies for w in workers)
+    ledger = options.get('ledger')
+    convicted = "%d/%d" % (len(ledger.dishonest), cheaters) if ledger else "-"
+    catch_rate = 1.0 - float(wrong) / lies if lies else 1.0
+    return float(executions) / num_tasks, wrong, catch_rate, convicted
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--tasks", dest="tasks", type="int",
+                      default=2000, help="number of tasks")
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      default=20, help="number of workers")
+    parser.add_option("-c", "--cheaters", dest="cheaters", type="int",
+                      default=2, help="number of cheating workers")
+    parser.add_option("-p", "--cheat", dest="cheat", type="float",
+                      default=0.2, help="probability that a cheater lies")
+    parser.add_option("-s", "--seed", dest="seed", type="int",
+                      default=262, help="random seed")
+    (options, args) = parser.parse_args()
+    # Every caught lie is logged
+    logging.disable(logging.ERROR)
+
+    runs = [("replicas=4 quorum=3", VerifiedTask,
+             lambda: dict(repetitions=4, quorum=3)),
+            ("replicas=2 quorum=2", VerifiedTask,
+             lambda: dict(repetitions=2, quorum=2))]
+    for rate in (0.01, 0.05, 0.1, 0.25):
+        runs.append(("spot checks rate=%g" % rate, SpotCheckedTask,
+                     lambda rate=rate: dict(ledger=TrustLedger(
+                         rate=rate, seed=options.seed))))
+
+    print "%-24s %9s %6s %11s %10s" % ("verification", "overhead", "wrong",
+                                        "catch rate", "convicted")
+    for name, TaskClass, make_options in runs:
+        overhead, wrong, catch_rate, convicted = simulate(
+            TaskClass, make_options(), options.tasks, options.workers,
+            options.cheaters, options.cheat, options.seed)
+        print "%-24s %9.2f %6d %10.1f%% %10s" % (
+            name, overhead, wrong, catch_rate * 100, convicted)
@@ -0,0 +1,78 @@
+"""Throughput benchmark for sending large messages over loopback
+
+Sends one message of each size from one Protocol to another in the same
+process, with both text and binary framing, and reports the throughput
+including pickling and unpickling.
+"""
+import time
+import socket
+import asyncore
+import optparse
+import cPickle as pickle
+from ec262.protocol import Protocol
+
+class Receiver(Protocol):
+    def __init__(self, conn, wire):
+        Protocol.__init__(self, conn)
+        if wire:
+            self.set_wire_format(**wire)
+        self.received = None
+        self.register_command('blob', self.receive)
+
+    def receive(self, command, data):
+        self.received = time.time()
+        self.handle_close()
+
+class Sender(Protocol):
+    def __init__(self, address, payload, wire):
+        Protocol.__init__(self)
+        if wire:
+            self.set_wire_format(**wire)
+        self.payload = payload
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def handle_connect(self):
+        self.send_command('blob', self.payload)
+        self.payload = None
+
+class Listener(asyncore.dispatcher):
+    def __init__(self, wire):
+        asyncore.dispatcher.__init__(self)
+        self.wire = wire
+        self.receiver = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.bind(("127.0.0.1", 0))
+        self.listen(1)
+
+    def handle_accept(self):
+        conn, addr = self.accept()
+        self.receiver = Receiver(conn, self.wire)
+        self.close()
+
+def transfer(size, wire):
+    """Send a `size` byte message; return the throughput in MB/s"""
+    payload = 'x' * size
+    listener = Listener(wire)
+    start = time.time()
+    Sender(listener.getsockname(), payload, wire)
+    del payload
+    asyncore.loop(timeout=0.1)
+    return size / (listener.receiver.received - start) / 2 ** 20
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-m", "--max-size", dest="max_size", type="int",
+                      default=256, help="largest message in MB (up to 1024)")
+    (options, args) = parser.parse_args()
+
+    formats = [
+        ("text", None),
+        ("binary", {'pickle_protocol': pickle.HIGHEST_PROTOCOL}),
+    ]
+    print "%8s %12s %12s" % ("MB", "text MB/s", "binary MB/s")
+    size = 1
+    while size <= options.max_size:
+        rates = [transfer(size * 2 ** 20, wire) for name, wire in formats]
+        print "%8d %12.1f %12.1f" % tuple([size] + rates)
+        size *= 4
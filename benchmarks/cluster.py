@@ -0,0 +1,100 @@
+"""A cluster of workers on loopback for benchmarks
+
+Starts a stand-in discovery service (see ec262.localdiscovery) in a thread
+and `workers` ec262.worker.Server instances, each in its own process so
+that the foreman's memory and CPU use are its own. Every worker registers
+with the stand-in, and the cluster's addresses are the ones it knows about,
+as a foreman would find them. Also has the helpers other benchmarks
+share for ports and memory use.
+"""
+import sys
+import time
+import signal
+import socket
+import logging
+import resource
+import multiprocessing
+from ec262.worker import Server
+from ec262.discovery import DiscoveryClient
+from ec262.localdiscovery import LocalDiscoveryServer
+
+def free_port():
+    """A port on loopback that nothing is listening on right now"""
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def peak_rss():
+    """Peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def serve(port, processes, discovery_url):
+    # Server.run closes the pool on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.getLogger().setLevel(logging.ERROR)
+    client = DiscoveryClient(discovery_url)
+    client.register_worker(port, ttl=24 * 60 * 60)
+    client.close()
+    Server(processes).run(port)
+
+def listening(address):
+    try:
+        socket.create_connection(address, 1).close()
+        return True
+    except socket.error:
+        return False
+
+
+class LocalCluster(object):
+    def __init__(self, workers=3, processes=1):
+        self.size = workers
+        self.processes = processes
+        self.discovery = None
+        self.servers = []
+        self.workers = []
+
+    def start(self, timeout=10.0):
+        """Start the discovery stand-in and the workers, and wait until
+        every worker is listening
+        """
+        self.discovery = LocalDiscoveryServer()
+        url = self.discovery.start()
+        for i in xrange(self.size):
+            process = multiprocessing.Process(
+                target=serve, args=(free_port(), self.processes, url))
+            process.start()
+            self.servers.append(process)
+        deadline = time.time() + timeout
+        while True:
+            with self.discovery.state.lock:
+                registered = self.discovery.state.live_workers()
+            addresses = [(host, int(port)) for host, port in
+                         (worker.split(":") for worker in registered)]
+            if (len(addresses) == self.size and
+                all(listening(address) for address in addresses)):
+                break
+            if time.time() > deadline:
+                self.stop()
+                raise RuntimeError("Workers didn't start in %.0fs" % timeout)
+            time.sleep(0.05)
+        self.workers = sorted(addresses)
+        return self.workers
+
+    def stop(self):
+        for process in self.servers:
+            process.terminate()
+        for process in self.servers:
+            process.join()
+        self.servers = []
+        if self.discovery is not None:
+            self.discovery.stop()
+            self.discovery = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,29 +1,184 @@
 from foreman import Foreman
 from worker import Server
-from settings import DEFAULT_PORT, VERSION
+from sources import LineFileSource
+from task import TaskFailed
+from tracing import Tracer, JobProfile, JSONLinesExporter, \
+                    PrometheusExporter
+from settings import DEFAULT_PORT, VERSION, MIN_CHUNK_ROWS, MAX_CHUNK_ROWS, \
+                     CHUNK_TARGET_TIME, CHUNK_TARGET_BYTES, \
+                     COMPRESS_THRESHOLD, REPLICAS, QUORUM, MAX_REPLICAS, \
+                     SPOT_CHECK_RATE, SHUFFLE_MEMORY_BUDGET, \
+                     SPECULATION_MULTIPLE
 
 MAPPER = None
 REDUCER = None
+COMBINER = None
 
-def mapper(f):
+def _batch(f, batch):
+    """Mark `f` as a batch function if `batch` is set"""
+    if batch:
+        f.ec262_batch = True
+    return f
+
+def mapper(f=None, batch=False):
+    """Use `f` as the map function
+    
+    A mapper is called with a key and a value and yields (key, value)
+    pairs. With `@mapper(batch=True)`, it is called once per chunk instead,
+    with a list of keys and a list of values, and returns a pair of
+    sequences of keys and values. These can be NumPy arrays.
+    """
+    if f is None:
+        return lambda f: mapper(f, batch)
     global MAPPER
-    MAPPER = f
+    MAPPER = _batch(f, batch)
     return f
 
-def reducer(f):
+def reducer(f=None, batch=False):
+    """Use `f` as the reduce function
+    
+    A reducer is called with a key and a tuple of its values and yields
+    (key, value) pairs. With `@reducer(batch=True)`, it is called once per
+    chunk instead, with a list of keys and a list of tuples of values, and
+    returns a pair of sequences of keys and values.
+    """
+    if f is None:
+        return lambda f: reducer(f, batch)
     global REDUCER
-    REDUCER = f
+    REDUCER = _batch(f, batch)
+    return f
+
+def combiner(f=None, batch=False):
+    """Run `f` on each worker's map output before it is sent back
+    
+    A combiner takes the same arguments as a reducer and should give the
+    same final result whether or not it is applied, e.g. a sum. Decorating
+    a reducer with both `combiner` and `reducer` uses it for both, called
+    per chunk if either decorator sets `batch`.
+    """
+    if f is None:
+        return lambda f: combiner(f, batch)
+    global COMBINER
+    COMBINER = _batch(f, batch)
     return f
 
-def run_job(data, workers = None):
+def run_job(data, workers = None, min_rows=MIN_CHUNK_ROWS,
+            max_rows=MAX_CHUNK_ROWS, target_time=CHUNK_TARGET_TIME,
+            target_bytes=CHUNK_TARGET_BYTES, window=None,
+            compress_threshold=COMPRESS_THRESHOLD, replicas=REPLICAS,
+            quorum=QUORUM, max_replicas=MAX_REPLICAS, verification='replicas',
+            check_rate=SPOT_CHECK_RATE, shuffle_memory=SHUFFLE_MEMORY_BUDGET,
+            shuffle='foreman', speculation=SPECULATION_MULTIPLE,
+            backend='workers', processes=None, exporters=(),
+            summary=False, profile=False):
+    """Run a MapReduce job over `data` on the given workers
+    
+    `data` is a dictionary, an iterable of (key, value) pairs such as a
+    generator, or a file source like `LineFileSource`. It is read a chunk
+    at a time as workers need tasks, so it doesn't have to fit in memory.
+    
+    Data is sent to workers in chunks whose size adapts to how long tasks
+    take: chunks aim to take `target_time` seconds and `target_bytes` bytes,
+    and contain between `min_rows` and `max_rows` rows. Setting `min_rows`
+    and `max_rows` to the same value gives a fixed chunk size.
+    
+    Each worker is kept busy with up to `window` tasks at a time, which
+    defaults to one more than the number of processes it runs tasks in.
+    Messages larger than `compress_threshold` bytes are compressed if the
+    worker supports it; pass None to turn compression off.
+    
+    Every task runs on `replicas` workers, and its result is used once
+    `quorum` of them agree on it. Only one replica sends back the full
+    result; the others send a digest. Tasks whose replicas disagree are
+    sent to more workers, up to `max_replicas`. Once workers go away, no
+    task waits for more replicas or votes than the workers left can give.
+    
+    With `verification='spotcheck'`, tasks run on one worker instead, and
+    each is checked on another with probability `check_rate`. Workers that
+    fail checks are checked more often, and those found to be dishonest get
+    no more tasks and have their results computed again.
+    
+    Map output is grouped by key on this machine in up to `shuffle_memory`
+    bytes, and spilled to sorted temporary files beyond that, which are
+    merged as the reduce tasks are created. With `shuffle='workers'`, map
+    output stays on the workers instead: reduce tasks fetch it from the
+    workers that computed it and check it against the digests they agreed
+    on, and map tasks whose output none of them can send run again, unless
+    `data` can only be read once, like a generator. Workers must then be
+    able to reach each other at the addresses in `workers`.
+    
+    A task still running `speculation` times longer than the median task
+    is also sent to a worker that would otherwise be idle, and the first
+    result to be verified is used. Workers still running a task once it is
+    complete are told to cancel it, which only drops its result if they
+    have started computing it. Pass None to turn this off.
+    
+    With `backend='local'`, the job runs in `processes` processes on this
+    machine (one per core by default) instead of on `workers`. Tasks are
+    passed to them through pipes rather than over the network, and run
+    once each, without verification.
+    
+    The time each task spends being dispatched, sent, queued, run and
+    merged, among others, is measured (see tracing.py) and passed to each
+    of `exporters`, like `JSONLinesExporter(path)` or
+    `PrometheusExporter(path)`. With `summary=True`, a (result, summary)
+    pair is returned, where the summary has the job's wall time, number of
+    tasks and results received, bytes sent and received, the time of each
+    phase and the total, mean and maximum time of each span.
+    
+    With `profile` set, workers run the map and reduce functions under
+    cProfile and send back the stats of each task, which are merged into a
+    pstats.Stats for the whole job, in the summary's `profile`. Only the
+    stats of one run whose result was accepted are merged for each task,
+    so replicas and speculative copies don't add to the counts. If
+    `profile` is a path, the stats are also saved there.
+    
+    Raises TaskFailed if a task fails in a way that running it again won't
+    fix, like a result whose digest can't be computed to compare it with
+    those of its replicas, or a map or reduce function that raises, with
+    either backend. Its message is the traceback.
+    """
+    if backend not in ('workers', 'local'):
+        raise ValueError("Unknown backend: %s" % (backend,))
+    if backend == 'local' and shuffle == 'workers':
+        raise ValueError("The local backend shuffles on this machine")
     if workers is None:
         workers = [("localhost", DEFAULT_PORT)]
     f = Foreman()
     f.mapfn = MAPPER
     f.reducefn = REDUCER
+    f.combinefn = COMBINER
+    f.window = window
+    f.compress_threshold = compress_threshold
+    f.verification = verification
+    f.replication = dict(repetitions=replicas, quorum=quorum,
+                         max_repetitions=max_replicas)
+    f.spot_checks['rate'] = check_rate
+    f.shuffle['memory_budget'] = shuffle_memory
+    f.shuffle_mode = shuffle
+    f.speculation['multiple'] = speculation
+    f.chunking = dict(adaptive=True, rows=min_rows, min_rows=min_rows,
+                      max_rows=max_rows, target_time=target_time,
+                      target_bytes=target_bytes)
+    f.tracer = Tracer(exporters)
+    if profile:
+        f.profile = JobProfile()
     f.datasource = data
-    return f.run(workers)
+    if backend == 'local':
+        result = f.run_local(processes)
+    else:
+        result = f.run(workers)
+    if isinstance(profile, basestring):
+        f.profile.dump(profile)
+    if summary:
+        return result, f.stats
+    return result
 
-def run_worker(port=DEFAULT_PORT):
-    s = Server()
+def run_worker(port=DEFAULT_PORT, processes=None):
+    """Serve foremen on `port`, running tasks in `processes` processes
+    
+    Defaults to one process per core; with `processes=0` tasks run in the
+    same process as the network code.
+    """
+    s = Server(processes)
     s.run(port=port)
\ No newline at end of file
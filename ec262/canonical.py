@@ -0,0 +1,197 @@
+import re
+import json
+import struct
+import marshal
+import hashlib
+
+# Encoded data is produced in pieces of about this many bytes
+CHUNK_SIZE = 64 * 1024
+# Number of [key, value] pairs serialized at a time
+BATCH_SIZE = 1024
+
+ENCODINGS = ('json', 'binary')
+
+_FRAME = struct.Struct('!I')
+
+def _batches(data):
+    """The items of the dictionary `data` sorted by key, as lists of at most
+    BATCH_SIZE pairs
+
+    Only the keys are sorted up front, which takes much less memory than a
+    sorted list of every pair.
+    """
+    keys = sorted(data)
+    for i in xrange(0, len(keys), BATCH_SIZE):
+        yield [(key, data[key]) for key in keys[i:i + BATCH_SIZE]]
+
+def _default(obj):
+    """Encode sets in a fixed order; everything else JSON can't handle fails"""
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+_encoder = json.JSONEncoder(default=_default)
+
+def _iterjson(data):
+    """Encode the sorted pairs of `data` as a JSON list, a batch at a time"""
+    encode = _encoder.encode
+    pieces, size = ['['], 1
+    separator = ''
+    for batch in _batches(data):
+        # Drop the brackets around the batch to splice it into the list
+        piece = separator + encode(batch)[1:-1]
+        separator = ', '
+        pieces.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(pieces)
+            pieces, size = [], 0
+    pieces.append(']')
+    yield ''.join(pieces)
+
+def _iterbinary(data):
+    """Encode the sorted pairs of `data` as marshalled batches of pairs
+
+    Each batch is a frame prefixed with its length, and a frame of length 0
+    ends the data. Marshal format 0 doesn't refer back to interned strings,
+    so the same data always encodes the same way.
+    """
+    pieces, size = [], 0
+    for batch in _batches(data):
+        batch = marshal.dumps(batch, 0)
+        pieces.append(_FRAME.pack(len(batch)))
+        pieces.append(batch)
+        size += _FRAME.size + len(batch)
+        if size >= CHUNK_SIZE:
+            yield ''.join(pieces)
+            pieces, size = [], 0
+    pieces.append(_FRAME.pack(0))
+    yield ''.join(pieces)
+
+def iterencode(data, encoding='json'):
+    """Serialize the dictionary `data` the same way on every machine, in
+    pieces
+
+    Keys can come out of a dictionary in any order, so the [key, value]
+    pairs of `data` are sorted by key first. With the 'json' encoding they
+    are encoded as a JSON list, in which tuples and lists look the same.
+    The 'binary' encoding is faster and smaller, but only canonical between
+    machines running the same version of Python.
+    """
+    if encoding == 'json':
+        return _iterjson(data)
+    elif encoding == 'binary':
+        return _iterbinary(data)
+    raise ValueError("Unknown encoding: %s" % (encoding,))
+
+def dumps(data):
+    """Serialize the dictionary `data` as a sorted JSON list of pairs"""
+    return ''.join(_iterjson(data))
+
+def digest(data):
+    """A SHA-256 hex digest of `dumps(data)`, without building the string
+
+    Two results have the same digest when they have the same canonical
+    serialization, so workers can send this instead of a whole result to
+    show that they agree with it.
+    """
+    h = hashlib.sha256()
+    for piece in _iterjson(data):
+        h.update(piece)
+    return h.hexdigest()
+
+
+class _Decoder(object):
+    """Rebuilds a dictionary from its canonical encoding, fed in pieces
+
+    Pieces are only joined once there is enough data to decode something,
+    so a large value split over many pieces isn't copied over and over.
+    """
+
+    def __init__(self):
+        self.result = {}
+        self.finished = False
+        self._pieces = []
+        self._size = 0
+        self._wanted = 0
+
+    def feed(self, data):
+        self._pieces.append(data)
+        self._size += len(data)
+        if self._size >= self._wanted and not self.finished:
+            self._decode(False)
+
+    def close(self):
+        """Decode what is left and return the dictionary"""
+        if not self.finished:
+            self._decode(True)
+        if not self.finished or ''.join(self._pieces).strip():
+            raise ValueError("Truncated or corrupt data")
+        return self.result
+
+    def _decode(self, final):
+        buf = ''.join(self._pieces)
+        pos = self.parse(buf, final)
+        rest = buf[pos:]
+        self._pieces, self._size = [rest], len(rest)
+        # Wait for twice as much data before trying a partial item again
+        self._wanted = 2 * len(rest)
+
+
+class _JSONDecoder(_Decoder):
+    _separator = re.compile(r'[\s,]*')
+
+    def __init__(self):
+        _Decoder.__init__(self)
+        self.started = False
+        self.scanner = json.JSONDecoder()
+
+    def parse(self, buf, final):
+        pos, end = 0, len(buf)
+        while True:
+            pos = self._separator.match(buf, pos).end()
+            if pos == end:
+                return pos
+            if not self.started:
+                if buf[pos] != '[':
+                    raise ValueError("Expected a list at %d" % (pos,))
+                self.started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                self.finished = True
+                return pos + 1
+            try:
+                (key, value), pos = self.scanner.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                return pos
+            self.result[key] = value
+
+
+class _BinaryDecoder(_Decoder):
+    def parse(self, buf, final):
+        pos, end = 0, len(buf)
+        while end - pos >= _FRAME.size:
+            length, = _FRAME.unpack_from(buf, pos)
+            if length == 0:
+                self.finished = True
+                return pos + _FRAME.size
+            if end - pos < _FRAME.size + length:
+                break
+            start = pos + _FRAME.size
+            self.result.update(marshal.loads(buf[start:start + length]))
+            pos = start + length
+        return pos
+
+
+def decoder(encoding='json'):
+    """An object to `feed()` the pieces of an encoding of a dictionary, and
+    `close()` to get the dictionary back
+    """
+    if encoding == 'json':
+        return _JSONDecoder()
+    elif encoding == 'binary':
+        return _BinaryDecoder()
+    raise ValueError("Unknown encoding: %s" % (encoding,))
@@ -0,0 +1,211 @@
+import os
+import time
+import asyncore
+import cProfile
+import traceback
+import multiprocessing
+import cPickle as pickle
+import Queue
+import canonical
+import settings
+from sandbox import LRUCache, load_function
+from shuffle import ShuffleBuffer, batch_pairs, split
+
+# Most recently used sandboxed functions in this process
+_functions = LRUCache(settings.FUNCTION_CACHE_SIZE)
+
+def _load(functions, name):
+    """Return the sandboxed function called `name`, or None if not given
+    
+    `functions` maps names to (code hash, frozen code) pairs.
+    """
+    entry = functions.get(name)
+    if entry is None:
+        return None
+    digest, frozen = entry
+    return load_function(_functions, frozen, name, settings.ALLOWED_MODULES,
+                         digest=digest)
+
+def map_chunk(mapfn, combinefn, data, batch=()):
+    """Run the map function on the given key-value pairs
+    
+    The functions named in `batch` ('mapfn' or 'combinefn') are called
+    once for the whole chunk, with a list of keys and a list of values.
+    """
+    results = ShuffleBuffer()
+    if 'mapfn' in batch:
+        output = mapfn([row[0] for row in data], [row[1] for row in data])
+        results.add_pairs(batch_pairs(output))
+    else:
+        for row in data:
+            key, value = row
+            output = mapfn(key, value)
+            for key, value in output:
+                results.add(key, value)
+    if combinefn:
+        results.combine(combinefn, 'combinefn' in batch)
+    return results.materialize()
+
+def reduce_chunk(reducefn, data, batch=()):
+    """Run the reduce function on the given key-values pairs
+    
+    If 'reducefn' is in `batch`, it is called once for the whole chunk, with
+    a list of keys and a list of their tuples of values.
+    """
+    if 'reducefn' in batch:
+        output = reducefn([row[0] for row in data], [row[1] for row in data])
+        return dict(batch_pairs(output))
+    results = {}
+    for row in data:
+        key, values = row
+        output = reducefn(key, values)
+        for key, value in output:
+            results[key] = value
+    return results
+
+def execute(command, functions, data, digest=False, partitions=None,
+            batch=(), profile=False, submitted=None, pickled=False):
+    """Run a map or reduce task with the given frozen functions
+
+    Returns a (success, result, stats) tuple, where result is the traceback
+    of the exception raised by a failed task and stats is a dictionary of
+    measurements: the time the task took in `elapsed`, and the time it
+    waited for a process since it was `submitted` in `queue`. With
+    `digest` set, the result is replaced by its `canonical.digest`. With
+    `partitions` set, the result is split into that many partitions, and
+    is a (partitions, digests) pair of dictionaries keyed by partition.
+    The functions named in `batch` are called once per chunk. With
+    `profile` set, the task runs under cProfile and its stats (in the
+    `pstats` format) are in `profile`. With `pickled` set, the result is
+    returned pickled, so that a result that can't be pickled fails the task
+    here rather than in the pool, which would never return it.
+    """
+    profiler = cProfile.Profile() if profile else None
+    start = time.time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if command == 'map':
+            result = map_chunk(_load(functions, 'mapfn'),
+                               _load(functions, 'combinefn'), data, batch)
+        else:
+            result = reduce_chunk(_load(functions, 'reducefn'), data, batch)
+        if partitions:
+            parts = split(result, partitions)
+            result = parts, dict((index, canonical.digest(part))
+                                 for index, part in parts.iteritems())
+        elif digest:
+            result = canonical.digest(result)
+        if pickled:
+            result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        success = True
+    except Exception:
+        result, success = traceback.format_exc(), False
+    if profiler is not None:
+        profiler.disable()
+    stats = {'elapsed': time.time() - start}
+    if submitted is not None:
+        stats['queue'] = start - submitted
+    if profiler is not None:
+        profiler.create_stats()
+        stats['profile'] = profiler.stats
+    return success, result, stats
+
+
+class Engine(object):
+    """Runs map and reduce tasks for workers outside of the event loop
+
+    Tasks run in a pool of `processes` processes, one per core by default,
+    and are shared by every connection to the worker. Results come back to
+    the asyncore loop through a pipe, so callbacks run in the same thread as
+    the rest of the worker. With `processes=0`, tasks run inline and block
+    the loop while they do.
+    
+    The engine also remembers the frozen code of recently used functions
+    by hash in `code`, for every connection to look up.
+    """
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.code = LRUCache(settings.CODE_CACHE_SIZE)
+        self.pool = None
+        if processes > 0:
+            self.pool = multiprocessing.Pool(processes)
+            self.results = Queue.Queue()
+            self.waker = Waker(self.run_callbacks)
+
+    def submit(self, command, functions, data, callback, errback,
+               digest=False, partitions=None, batch=(), profile=False):
+        """Run a task; call `callback(result, stats)` or `errback(traceback)`
+
+        With `digest` set, the callback gets the digest of the result, and
+        with `partitions` set, the partitions of the result and their
+        digests (see `execute`).
+        """
+        args = (command, functions, data, digest, partitions, batch,
+                profile, time.time())
+        if self.pool is None:
+            self.finish(execute(*args), callback, errback)
+            return
+        args += (True,)
+        def done(outcome):
+            # Runs in the pool's result thread
+            self.results.put((outcome, callback, errback))
+            self.waker.wake()
+        self.pool.apply_async(execute, args, callback=done)
+
+    def run_callbacks(self):
+        """Call the callbacks of every task that has finished"""
+        while True:
+            try:
+                outcome, callback, errback = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            self.finish(outcome, callback, errback, pickled=True)
+
+    def finish(self, outcome, callback, errback, pickled=False):
+        success, result, stats = outcome
+        if success and pickled:
+            try:
+                result = pickle.loads(result)
+            except Exception:
+                result, success = traceback.format_exc(), False
+        if success:
+            callback(result, stats)
+        else:
+            errback(result)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.waker.close()
+            self.pool = None
+
+
+class Waker(asyncore.file_dispatcher):
+    """Wakes up the asyncore loop from another thread"""
+
+    def __init__(self, handler):
+        read, self._write = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read)
+        os.close(read)
+        self.handler = handler
+
+    def wake(self):
+        os.write(self._write, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.handler()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write)
@@ -0,0 +1,158 @@
+import time
+import asyncore
+import select
+import settings
+
+class ChannelMap(dict):
+    """An asyncore socket map that remembers which channels changed
+
+    asyncore adds and removes channels through the map, and `touch` is
+    called by channels whose readable() or writable() may have changed, so
+    the loop only has to look at those instead of every channel.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changed = set(self)
+        self.removed = set()
+
+    def __setitem__(self, fd, obj):
+        dict.__setitem__(self, fd, obj)
+        self.changed.add(fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.changed.discard(fd)
+        self.removed.add(fd)
+
+    def touch(self, fd):
+        self.changed.add(fd)
+
+    def pop_changes(self):
+        """Return and forget the removed and changed file descriptors"""
+        removed, changed = self.removed, self.changed
+        self.removed, self.changed = set(), set()
+        return removed, changed
+
+
+def install():
+    """Make the asyncore socket map a ChannelMap and return it
+
+    Channels that already exist are moved to the new map.
+    """
+    if not isinstance(asyncore.socket_map, ChannelMap):
+        channels = ChannelMap(asyncore.socket_map)
+        for obj in channels.itervalues():
+            obj._map = channels
+        asyncore.socket_map = channels
+    return asyncore.socket_map
+
+def interest(obj):
+    """The epoll events `obj` currently wants to hear about"""
+    mask = 0
+    if obj.readable():
+        mask |= select.EPOLLIN | select.EPOLLPRI
+    # accepting sockets should not be writable
+    if obj.writable() and not obj.accepting:
+        mask |= select.EPOLLOUT
+    return mask
+
+
+class Ticker(object):
+    """Calls `tick` when it is called if `interval` seconds have passed
+    since it last did, so loops can run it whether or not they had events
+    """
+
+    def __init__(self, tick, interval):
+        self.tick = tick
+        self.interval = interval
+        self.next = time.time() + interval
+
+    def __call__(self):
+        now = time.time()
+        if self.tick is not None and now >= self.next:
+            self.next = now + self.interval
+            self.tick()
+
+
+class EpollLoop(object):
+    """Runs asyncore channels with epoll
+
+    Unlike asyncore.loop, which asks every channel whether it is readable
+    and writable on every iteration, registrations are only updated for
+    channels that were added, removed, touched or had events, so an
+    iteration costs time in proportion to the number of active channels.
+    """
+
+    def __init__(self, map):
+        self.map = map
+        self.epoll = select.epoll()
+        self.registered = {}
+
+    def update(self, removed, changed):
+        for fd in removed:
+            if self.registered.pop(fd, None) is not None:
+                try:
+                    self.epoll.unregister(fd)
+                except (IOError, OSError):
+                    # Closing the socket already unregistered it
+                    pass
+        for fd in changed:
+            obj = self.map.get(fd)
+            if obj is None:
+                continue
+            mask = interest(obj)
+            old = self.registered.get(fd)
+            if mask == old or not (mask or old):
+                continue
+            if not mask:
+                del self.registered[fd]
+                self.epoll.unregister(fd)
+            elif old is None:
+                self.epoll.register(fd, mask)
+                self.registered[fd] = mask
+            else:
+                self.epoll.modify(fd, mask)
+                self.registered[fd] = mask
+
+    def run(self, timeout=30.0, tick=None):
+        ticker = Ticker(tick, timeout)
+        while self.map:
+            self.update(*self.map.pop_changes())
+            events = self.epoll.poll(timeout)
+            if not events:
+                # Catch channels whose interest changed without a touch
+                self.update((), list(self.map))
+            for fd, flags in events:
+                obj = self.map.get(fd)
+                if obj is None:
+                    continue
+                asyncore.readwrite(obj, flags)
+                self.map.touch(fd)
+            ticker()
+        self.epoll.close()
+
+
+def loop(timeout=30.0, poller=None, tick=None):
+    """Run every asyncore channel until they are all closed
+
+    `poller` is 'epoll', 'poll' or 'select', and defaults to
+    settings.EVENT_LOOP. epoll falls back to poll where it isn't available.
+    `tick` is called about every `timeout` seconds, even when no channel
+    has anything to do.
+    """
+    poller = poller or settings.EVENT_LOOP
+    if poller == 'epoll' and hasattr(select, 'epoll'):
+        EpollLoop(install()).run(timeout, tick)
+    elif tick is None:
+        asyncore.loop(timeout, use_poll=(poller != 'select'))
+    else:
+        # asyncore.loop, with the tick
+        if poller != 'select' and hasattr(select, 'poll'):
+            poll = asyncore.poll2
+        else:
+            poll = asyncore.poll
+        ticker = Ticker(tick, timeout)
+        while asyncore.socket_map:
+            poll(timeout, asyncore.socket_map)
+            ticker()
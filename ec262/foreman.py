@@ -1,27 +1,248 @@
-import asyncore
+import time
 import socket
 import logging
+import itertools
+import collections
+import eventloop
 from protocol import Protocol
-from task import MapReduceJob, RepeatedCommandTask
-from sandbox import freeze_function
+from task import MapReduceJob, VerifiedTask, SpotCheckedTask, TaskFailed
+from trust import TrustLedger
+from local import LocalBackend
+from tracing import Tracer
+from sandbox import freeze_function, code_hash
 import settings
 
 class Foreman(object):
     def __init__(self):
-        self.mapfn = self.reducefn = self.datasource = None
+        self.chunking = {}
+        self.idle = set()
+        self.window = None
+        self.compress_threshold = settings.COMPRESS_THRESHOLD
+        self.verification = 'replicas'
+        self.replication = dict(repetitions=settings.REPLICAS,
+                                quorum=settings.QUORUM,
+                                max_repetitions=settings.MAX_REPLICAS)
+        self.spot_checks = dict(rate=settings.SPOT_CHECK_RATE,
+                                escalation=settings.SPOT_CHECK_ESCALATION,
+                                strikes=settings.SPOT_CHECK_STRIKES)
+        self.shuffle = dict(partitions=settings.SHUFFLE_PARTITIONS,
+                            memory_budget=settings.SHUFFLE_MEMORY_BUDGET,
+                            directory=settings.SHUFFLE_DIR,
+                            max_runs=settings.SHUFFLE_MAX_RUNS)
+        self.shuffle_mode = 'foreman'
+        self.speculation = dict(multiple=settings.SPECULATION_MULTIPLE,
+                                copies=settings.SPECULATIVE_COPIES,
+                                min_samples=settings.SPECULATION_MIN_SAMPLES)
+        self.ledger = None
+        self.tracer = Tracer()
+        self.profile = None
+        self.profiles = {}
+        self.stats = None
+        self.error = None
+        self.stopping = False
+        self.controllers = []
+        self.backend = None
+        self._functions = None
+        self.mapfn = self.reducefn = self.combinefn = self.datasource = None
     
     def run(self, workers):
-        for worker in workers:
-            sc = WorkerController(worker, self)
-        asyncore.loop()
+        """Run the job on `workers` and return its result
+        
+        Raises TaskFailed if a task failed in a way that running it again
+        won't fix.
+        """
+        workers = list(workers)
+        start = time.time()
+        self.create_job(len(workers))
+        self.controllers = [WorkerController(worker, self)
+                            for worker in workers]
+        eventloop.loop(settings.TICK_INTERVAL, tick=self.tick)
+        self.tracer.close()
+        self.record_stats(time.time() - start, self.controllers)
+        if self.error is not None:
+            raise TaskFailed(self.error)
         return self.mapreducetasks.result
 
+    def run_local(self, processes=None):
+        """Run the job in `processes` processes on this machine
+        
+        The processes are trusted, so every task runs once, and never
+        speculatively since they all run at the same speed. See LocalBackend.
+        """
+        self.verification = 'replicas'
+        self.replication = dict(repetitions=1, quorum=1, max_repetitions=1)
+        self.speculation['multiple'] = None
+        self.shuffle_mode = 'foreman'
+        backend = self.backend = LocalBackend(self, processes)
+        start = time.time()
+        self.create_job(backend.processes)
+        try:
+            backend.start()
+            eventloop.loop()
+        finally:
+            backend.close()
+        self.tracer.close()
+        self.record_stats(time.time() - start, ())
+        if self.error is not None:
+            raise TaskFailed(self.error)
+        return self.mapreducetasks.result
+    
+    def fail(self, error):
+        """Stop the job because of a task that can't succeed
+        
+        Every worker is disconnected, which ends the event loop, and `run`
+        raises TaskFailed with `error`, the traceback.
+        """
+        if self.error is None:
+            logging.error("Task failed:\n%s" % (error,))
+            self.error = error
+        for controller in self.controllers:
+            controller.disconnecting = True
+            controller.close()
+        if self.backend is not None:
+            self.backend.close()
+
+    def record_stats(self, elapsed, controllers):
+        """Set `stats` to how long the job took, its phases, the bytes
+        sent to and received from `controllers` and the summary of the spans
+        of its tasks
+        """
+        phases = self.mapreducetasks.phases
+        trace = self.tracer.summary()
+        self.stats = dict(
+            elapsed=elapsed,
+            tasks=sum(phase['tasks'] for phase in phases.itervalues()),
+            bytes_sent=sum(c.bytes_sent for c in controllers),
+            bytes_received=sum(c.bytes_received for c in controllers),
+            phases=phases,
+            results=trace['results'],
+            spans=trace['spans'],
+            profile=self.profile and self.profile.stats)
+
     def set_datasource(self, ds):
-        """Set the data to process and create a new TaskManager for it"""
+        """Set the data to process: a dictionary, an iterable of (key,
+        value) pairs or a source with an `iteritems()` method
+        """
         self._datasource = ds
-        self.mapreducetasks = MapReduceJob(self._datasource, RepeatedCommandTask, repetitions=4)
+    
+    def create_job(self, num_workers):
+        """Create a new TaskManager for the data
+        
+        Tasks are verified by running them on `replication['repetitions']`
+        workers, or, if `verification` is 'spotcheck', by checking some of
+        them on another worker. Each replica of a task runs on a different
+        worker, so there are never more replicas than workers.
+        
+        Partitions of the map output are reduced early if the reducer is
+        also the combiner, which makes reducing partial results safe. If
+        `shuffle_mode` is 'workers', workers send each other the map output
+        instead of sending it through the foreman.
+        """
+        early_reduce = (self.combinefn is not None and
+                        self.combinefn is self.reducefn)
+        if self.verification == 'spotcheck':
+            spot_checks = dict(self.spot_checks)
+            if num_workers < 2:
+                spot_checks['rate'] = 0
+            self.ledger = TrustLedger(**spot_checks)
+            TaskClass = SpotCheckedTask
+            options = dict(ledger=self.ledger,
+                           max_repetitions=min(3, num_workers))
+        else:
+            TaskClass = VerifiedTask
+            options = dict((key, min(value, num_workers))
+                           for key, value in self.replication.iteritems())
+        self.mapreducetasks = MapReduceJob(self._datasource, TaskClass,
+                                           chunking=self.chunking,
+                                           shuffle=self.shuffle,
+                                           early_reduce=early_reduce,
+                                           speculation=self.speculation,
+                                           remote_shuffle=(self.shuffle_mode ==
+                                                           'workers'),
+                                           **options)
         self.tasks = iter(self.mapreducetasks)
     
+    def frozen_functions(self):
+        """The functions to send to workers, frozen once per job
+        
+        Maps the name of each function that is set to a (code hash, frozen
+        code) pair.
+        """
+        if self._functions is None:
+            self._functions = collections.OrderedDict()
+            for name in ('mapfn', 'reducefn', 'combinefn'):
+                fn = getattr(self, name)
+                if fn:
+                    frozen_fn = freeze_function(fn)
+                    self._functions[name] = (code_hash(frozen_fn), frozen_fn)
+        return self._functions
+    
+    def batch_functions(self):
+        """The names of the functions that are called once per chunk"""
+        return [name for name in ('mapfn', 'reducefn', 'combinefn')
+                if getattr(getattr(self, name), 'ec262_batch', False)]
+    
+    def tick(self):
+        """Called by the event loop every TICK_INTERVAL seconds
+        
+        Idle workers only ask for a task again when a result comes in, so
+        they are woken here too, to run copies of tasks that have become
+        stragglers since. Once the job has been over for a tick, which
+        leaves time for the last spans to come in, workers that are still
+        connected are disconnected, since one that stopped responding
+        might never read the command to.
+        """
+        if self.mapreducetasks.finished:
+            if self.stopping:
+                for controller in self.controllers:
+                    controller.disconnecting = True
+                    controller.close()
+            self.stopping = True
+        else:
+            self.wake_idle()
+    
+    def profile_result(self, task, worker, profile, completed):
+        """Merge the profile of the result `task` used into the job's stats
+        
+        `profile` is the one `worker` sent with its result, and `completed`
+        whether that result completed the task. Profiles are kept until the
+        task is complete, and then only the one of a worker that reported
+        the accepted result is merged, so replicas and speculative copies
+        aren't counted.
+        """
+        if self.profile is None:
+            return
+        if not completed:
+            if profile and task.state != task.COMPLETE:
+                self.profiles.setdefault(task, {})[worker] = profile
+            return
+        profiles = self.profiles.pop(task, {})
+        if profile:
+            profiles[worker] = profile
+        for agreeing in task.agreeing():
+            if agreeing in profiles:
+                self.profile.add(profiles[agreeing])
+                break
+    
+    def worker_lost(self, controller):
+        """Have the job make do with the workers that are left once
+        `controller`'s worker went away
+        
+        Each replica of a task runs on a different worker, so tasks can't
+        wait for more replicas than there are workers left.
+        """
+        if self.mapreducetasks.finished:
+            return
+        workers = set(c for c in self.controllers if not c.disconnecting)
+        self.mapreducetasks.limit_replicas(workers)
+        self.wake_idle()
+    
+    def wake_idle(self):
+        """Give workers that are waiting for a task another chance to start"""
+        idle, self.idle = self.idle, set()
+        for controller in idle:
+            controller.start_new_task()
+    
     def get_datasource(self):
         """Get the data that we are processing/will process"""
         return self._datasource
@@ -33,37 +254,255 @@ class WorkerController(Protocol):
         """Connect to the specified worker"""
         Protocol.__init__(self)
         self.server = server
+        self.address = worker
         self.register_command('taskcomplete', self.complete_task)
-        self.register_command('ready', lambda x, y: self.initialize_worker())
+        self.register_command('taskfailed', self.fail_task)
+        self.register_command('taskspans', self.record_spans)
+        self.register_command('ready', lambda x, options:
+                              self.initialize_worker(options))
+        self.register_command('fnwant', self.send_functions)
+        self.inflight = collections.OrderedDict()
+        self.cancelled = set()
+        self.tags = itertools.count()
+        self.traces = {}
+        self.traced = {}
+        self.tracing = False
+        self.dispatch_started = None
+        self.tagged = False
+        self.digests = False
+        self.cancels = False
+        self.window = 1
+        self.disconnecting = False
         # Create connection
         logging.debug("Connecting to worker %s:%d..." % worker)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect(worker)
 
-    def initialize_worker(self):
-        """Upon connecting, send the map/reduce functions and start a task"""
-        if self.server.mapfn:
-            self.send_command('mapfn', freeze_function(self.server.mapfn))
-        if self.server.reducefn:
-            self.send_command('reducefn', freeze_function(self.server.reducefn))
+    def initialize_worker(self, options=None):
+        """Upon connecting, send the map/reduce functions and start tasks
+        
+        Workers that support pipelining list it in the options they send
+        with `ready`. Those get up to `window` tasks at a time (by default
+        one more than they have processes), tagged so that their results
+        can come back in any order, and can be asked for just the digest of
+        a result or to cancel a task if they support it. Other workers get
+        one task at a time. If the worker lists the wire formats it
+        supports, both ends switch to the best one after `configure`.
+        Workers that cache functions are offered their hashes first, and
+        only sent the code they ask for. Workers that can't shuffle with
+        other workers are dropped from jobs that need them to, and so are
+        those that can't run batch functions. Workers that can trace tasks
+        are asked to, and to profile them if the job has a `profile`.
+        """
+        options = options or {}
+        if (self.server.shuffle_mode == 'workers' and
+            not (options.get('shuffle') and options.get('pipeline'))):
+            logging.error("Worker %s:%d can't shuffle with other workers" %
+                          self.address)
+            self.handle_close()
+            return
+        batch = self.server.batch_functions()
+        if batch and not options.get('batch'):
+            logging.error("Worker %s:%d can't run batch functions" %
+                          self.address)
+            self.handle_close()
+            return
+        configuration = {}
+        if batch:
+            configuration['batch'] = batch
+        if options.get('pipeline'):
+            self.tagged = configuration['pipeline'] = True
+            self.window = self.server.window or options.get('processes', 1) + 1
+            self.digests = options.get('digest', False)
+            self.cancels = options.get('cancel', False)
+            if options.get('trace'):
+                self.tracing = configuration['trace'] = True
+            if self.server.profile is not None and options.get('profile'):
+                configuration['profile'] = True
+        wire = self.choose_wire_format(options.get('wire'),
+                                       self.server.compress_threshold)
+        if wire:
+            configuration['wire'] = wire
+        if configuration:
+            self.send_command('configure', configuration)
+        if wire:
+            self.set_wire_format(**wire)
+        functions = self.server.frozen_functions()
+        if options.get('fncache'):
+            self.send_command('fnoffer', dict(
+                (name, digest) for name, (digest, frozen_fn)
+                in functions.iteritems()))
+        else:
+            self.send_functions(None, functions.keys())
+    
+    def send_functions(self, command, names):
+        """Send the code of the named functions, then start tasks"""
+        functions = self.server.frozen_functions()
+        for name in names:
+            self.send_command(name, functions[name][1])
         self.start_new_task()
-            
+    
     def handle_close(self):
-        """Override default close handler"""
+        """Hand the tasks the worker was running back to the job"""
         logging.info("Client disconnected")
+        self.server.idle.discard(self)
+        self.disconnecting = True
         self.close()
+        inflight, self.inflight = self.inflight, collections.OrderedDict()
+        self.traces.clear()
+        self.traced.clear()
+        for task in inflight.itervalues():
+            task.worker_lost(self)
+        self.server.worker_lost(self)
         
     def start_new_task(self):
-        """Ask the TaskManager what to do next and pass message to worker"""
-        task = self.server.tasks.next()
-        if task == None:
-            logging.debug('No tasks to perform')
-            self.handle_close()
-        self.task = task
-        task.add_worker(self)
+        """Ask the TaskManager what to do next until the window is full
+        
+        No task is sent while the connection is congested; the ones the
+        window still has room for are once it has drained.
+        """
+        while (not self.disconnecting and not self.congested and
+               len(self.inflight) < self.window):
+            start = time.time()
+            task = self.server.tasks.next(self)
+            if task is None:
+                logging.debug('No tasks to perform yet')
+                self.server.idle.add(self)
+                return
+            self.dispatch_started = start
+            task.add_worker(self)
+    
+    def handle_drained(self):
+        self.start_new_task()
+    
+    def send_task(self, task, digest=False):
+        """Send the command for `task` and wait for its result
+        
+        With `digest` set, the worker is asked for only the digest of the
+        result. Returns whether it was, which it can't be if the worker
+        doesn't support it.
+        """
+        if task.command == 'disconnect':
+            self.disconnecting = True
+            self.send_command(task.command, task.data)
+            return False
+        tag = self.tags.next()
+        self.inflight[tag] = task
+        start = time.time()
+        dispatch = None
+        if self.dispatch_started is not None:
+            dispatch = start - self.dispatch_started
+            self.dispatch_started = None
+        if not self.tagged:
+            digest = False
+            self.send_command(task.command, task.data)
+        else:
+            envelope = {'id': tag, 'data': task.data}
+            if task.shuffle:
+                envelope['shuffle'] = task.shuffle
+            digest = digest and self.digests
+            if digest:
+                envelope['digest'] = True
+            self.send_command(task.command, envelope)
+        sent = time.time()
+        self.traces[tag] = (sent, {'dispatch': dispatch, 'send': sent - start})
+        return digest
 
+    def cancel_task(self, task):
+        """Tell the worker to stop running `task`, if it still is
+        
+        Called when another worker completes the task first. Workers that
+        can't cancel tasks just finish them, and their result is ignored.
+        The worker gets a new task once the one that completed `task` does.
+        """
+        if not self.cancels:
+            return
+        for tag, inflight in self.inflight.items():
+            if inflight is task:
+                del self.inflight[tag]
+                self.traces.pop(tag, None)
+                self.cancelled.add(tag)
+                self.send_command('cancel', {'id': tag})
+                if task.job is not None:
+                    task.job.task_cancelled(task, self)
+                self.server.idle.add(self)
+    
     def complete_task(self, command, data):
-        """Recieve the results of a map task"""
-        self.task.complete(self, data)
-        self.task = None
-        self.start_new_task()
\ No newline at end of file
+        """Recieve the results of a task
+        
+        Tagged results carry the time the worker spent on the task, and
+        either the result or its digest; untagged results are for the oldest
+        task sent. The spans of the task measured here are passed to the
+        tracer, or, if the worker traces tasks, kept until it sends its own
+        (see `record_spans`).
+        """
+        received = time.time()
+        spans = {'receive': self.decode_time}
+        digest = None
+        if self.tagged:
+            tag, result = data['id'], data.get('result')
+            elapsed, digest = data.get('elapsed'), data.get('digest')
+        else:
+            tag, result, elapsed = next(iter(self.inflight), None), data, None
+        task = self.inflight.pop(tag, None)
+        sent, sent_spans = self.traces.pop(tag, (None, {}))
+        if task is None and tag in self.cancelled:
+            # Sent before the worker got the cancel command
+            self.cancelled.discard(tag)
+            return
+        if task is None:
+            logging.warning("Result for unknown task %s" % (tag,))
+            return
+        spans.update(sent_spans)
+        if sent is not None:
+            spans['latency'] = received - sent
+        start = time.time()
+        complete = task.state == task.COMPLETE
+        try:
+            task.complete(self, result, elapsed, digest)
+        except TaskFailed, e:
+            self.server.fail(str(e))
+            return
+        spans['merge'] = time.time() - start
+        if self.tagged:
+            self.server.profile_result(
+                task, self, data.get('profile'),
+                not complete and task.state == task.COMPLETE)
+        if self.tracing:
+            self.traced[tag] = (task, spans)
+        else:
+            self.server.tracer.record(task, self, spans)
+        self.start_new_task()
+        self.server.wake_idle()
+    
+    def record_spans(self, command, data):
+        """Pass the spans the worker measured for a task, which it sends
+        after the result, to the tracer with those measured here
+        """
+        traced = self.traced.pop(data['id'], None)
+        if traced is not None:
+            task, spans = traced
+            spans.update(data['spans'])
+            self.server.tracer.record(task, self, spans)
+    
+    def fail_task(self, command, data):
+        """Hand a task the worker couldn't run back to its job
+        
+        The worker stays connected. `error` is the traceback when a user
+        function raised, which fails the job. `key` is set when the task is
+        a reduce task that couldn't fetch a partition of the output of the
+        map task stored under it, which the job can run again.
+        """
+        tag = data['id']
+        task = self.inflight.pop(tag, None)
+        self.traces.pop(tag, None)
+        if task is None:
+            self.cancelled.discard(tag)
+            return
+        try:
+            task.job.task_failed(task, self, data['error'], data.get('key'))
+        except TaskFailed, e:
+            self.server.fail(str(e))
+            return
+        self.start_new_task()
+        self.server.wake_idle()
\ No newline at end of file
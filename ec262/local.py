@@ -0,0 +1,117 @@
+import time
+import multiprocessing
+from engine import Engine
+from task import TaskFailed
+
+class LocalBackend(object):
+    """Runs the tasks of a foreman's job in a pool of processes on this
+    machine instead of on remote workers
+
+    Tasks go to the processes through the pipes of a multiprocessing pool
+    (see Engine), so there is no connection, framing or wire format, and
+    results come back to the event loop like a worker's. Each process is
+    represented to the job by a LocalWorker.
+    """
+
+    def __init__(self, server, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes < 1:
+            raise ValueError("The local backend needs at least one process")
+        self.server = server
+        self.processes = processes
+        self.engine = Engine(processes)
+        self.workers = [LocalWorker(self, i) for i in xrange(processes)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start_new_task()
+
+    def worker_done(self, worker):
+        """Shut the pool down once every worker has been disconnected"""
+        if all(w.disconnecting for w in self.workers):
+            self.close()
+
+    def close(self):
+        """Stop handing out tasks and shut the pool down"""
+        for worker in self.workers:
+            worker.disconnecting = True
+        self.engine.close()
+
+
+class LocalWorker(object):
+    """Stands in for a WorkerController, running tasks in the processes of
+    a LocalBackend
+
+    Up to `window` tasks are queued at a time so that the process never
+    waits for the next one. Results are used as they are, without digests
+    or verification, since the processes are trusted.
+    """
+    window = 2
+
+    def __init__(self, backend, index):
+        self.backend = backend
+        self.server = backend.server
+        self.address = ('local', index)
+        self.inflight = set()
+        self.disconnecting = False
+
+    def start_new_task(self):
+        """Ask the job what to do next until the window is full"""
+        while not self.disconnecting and len(self.inflight) < self.window:
+            task = self.server.tasks.next(self)
+            if task is None:
+                self.server.idle.add(self)
+                return
+            task.add_worker(self)
+
+    def send_task(self, task, digest=False):
+        """Submit the command for `task` to the pool; never sends digests"""
+        if task.command == 'disconnect':
+            self.disconnecting = True
+            self.server.idle.discard(self)
+            self.backend.worker_done(self)
+            return False
+        self.inflight.add(task)
+        start = time.time()
+        def callback(result, stats):
+            spans = {'latency': time.time() - start,
+                     'queue': stats.get('queue'), 'run': stats['elapsed']}
+            self.complete_task(task, result, stats, spans)
+        self.backend.engine.submit(task.command,
+                                   self.server.frozen_functions(), task.data,
+                                   callback, self.fail_task,
+                                   batch=self.server.batch_functions(),
+                                   profile=self.server.profile is not None)
+        return False
+
+    def cancel_task(self, task):
+        """Tasks in the pool can't be stopped; their result is ignored"""
+        pass
+
+    def complete_task(self, task, result, stats, spans):
+        if task not in self.inflight:
+            return
+        self.inflight.discard(task)
+        start = time.time()
+        complete = task.state == task.COMPLETE
+        try:
+            task.complete(self, result, stats.get('elapsed'))
+        except TaskFailed, e:
+            self.server.fail(str(e))
+            return
+        spans['merge'] = time.time() - start
+        self.server.profile_result(task, self, stats.get('profile'),
+                                   not complete and
+                                   task.state == task.COMPLETE)
+        self.server.tracer.record(task, self, spans)
+        self.start_new_task()
+        self.server.wake_idle()
+
+    def fail_task(self, error):
+        """Stop the job when a user function raises an exception
+
+        Foreman.run_local then raises TaskFailed with `error`, the
+        traceback.
+        """
+        self.server.fail(error)
@@ -0,0 +1,236 @@
+'''
+localdiscovery.py
+-----------------
+
+A stand-in for the discovery service that runs locally, for testing and
+benchmarking without touching the production database. It keeps everything
+in memory and implements the same HTTP endpoints the client uses:
+
+    GET    /seed         Reset state and create three free tasks
+    POST   /workers      Register a worker (port, ttl)
+    POST   /tasks        Get n tasks, each with three workers
+    GET    /tasks/<id>   Get the key to encrypt a task's data
+    DELETE /tasks/<id>   Get the key to decrypt a task's data (valid=1),
+                         destroying it, or a refund (valid=0)
+
+Every task costs one credit per worker. Run it with
+`python -m ec262.localdiscovery [PORT]`, or start one in a background
+thread with `LocalDiscoveryServer().start()`.
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+from base64 import b64encode
+
+WORKERS_PER_TASK = 3
+INITIAL_CREDITS = 1000
+
+class DiscoveryState(object):
+    ''' Workers, tasks, keys and credits of the stand-in service '''
+
+    def __init__(self, credits=INITIAL_CREDITS):
+        self.lock = threading.Lock()
+        self.reset(credits)
+
+    def reset(self, credits=INITIAL_CREDITS):
+        self.credits = credits
+        self.initial_credits = credits
+        self.workers = {}
+        self.tasks = {}
+
+    def seed(self):
+        ''' Forget everything and create three tasks for free '''
+        self.reset(self.initial_credits)
+        tasks = self.create_tasks(3)
+        self.credits = self.initial_credits
+        return tasks
+
+    def register_worker(self, host, port, ttl):
+        address = "%s:%d" % (host, port)
+        self.workers[address] = time.time() + ttl
+        return {"id": address, "credits": self.credits, "ttl": ttl}
+
+    def live_workers(self):
+        now = time.time()
+        return [w for w, expires in self.workers.iteritems() if expires > now]
+
+    def create_tasks(self, n):
+        ''' Returns the new tasks, or None if there aren't enough credits '''
+        if n * WORKERS_PER_TASK > self.credits:
+            return None
+        self.credits -= n * WORKERS_PER_TASK
+        workers = self.live_workers() or ["localhost:11235"]
+        tasks = {}
+        for i in xrange(n):
+            task_id = uuid.uuid4().hex
+            if len(workers) >= WORKERS_PER_TASK:
+                chosen = random.sample(workers, WORKERS_PER_TASK)
+            else:
+                chosen = [random.choice(workers)
+                          for j in xrange(WORKERS_PER_TASK)]
+            self.tasks[task_id] = {"workers": chosen, "key": os.urandom(16)}
+            tasks[task_id] = chosen
+        return tasks
+
+
+class DiscoveryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Serves the discovery endpoints over HTTP/1.1 with keep-alive '''
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def form(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        fields = urlparse.parse_qs(self.rfile.read(length))
+        return dict((k, v[0]) for k, v in fields.iteritems())
+
+    def route(self):
+        ''' Returns the path split into parts, ignoring repeated slashes '''
+        return [p for p in self.path.split("?")[0].split("/") if p]
+
+    def do_GET(self):
+        state = self.server.state
+        path = self.route()
+        self.form()
+        with state.lock:
+            if path == ["seed"]:
+                self.reply(200, state.seed())
+            elif len(path) == 2 and path[0] == "tasks":
+                task = state.tasks.get(path[1])
+                if task is None:
+                    self.reply(404, {"error": "unknown task"})
+                else:
+                    self.reply(200, {"key": b64encode(task["key"])})
+            else:
+                self.reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        state = self.server.state
+        path = self.route()
+        form = self.form()
+        with state.lock:
+            if path == ["workers"]:
+                info = state.register_worker(self.client_address[0],
+                                             int(form.get("port", 0)),
+                                             int(form.get("ttl", 60)))
+                self.reply(200, info)
+            elif path == ["tasks"]:
+                n = int(form.get("n", 1))
+                tasks = state.create_tasks(n)
+                if tasks is None:
+                    self.reply(406, {"available_credits": state.credits,
+                                     "needed_credits": n * WORKERS_PER_TASK})
+                else:
+                    self.reply(200, tasks)
+            else:
+                self.reply(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        state = self.server.state
+        path = self.route()
+        form = self.form()
+        with state.lock:
+            if len(path) != 2 or path[0] != "tasks":
+                self.reply(404, {"error": "not found"})
+                return
+            task = state.tasks.pop(path[1], None)
+            if task is None:
+                self.reply(404, {"error": "unknown task"})
+            elif form.get("valid") == "0":
+                state.credits += WORKERS_PER_TASK
+                self.reply(200, {"credits": state.credits})
+            else:
+                self.reply(200, {"key": b64encode(task["key"])})
+
+
+class LocalDiscoveryServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    ''' A threaded HTTP server for the stand-in discovery service. Binds
+        to a free port on localhost unless `port` is given, and gives
+        callers `credits` to spend on tasks.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, host="127.0.0.1", credits=INITIAL_CREDITS):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           DiscoveryHandler)
+        self.state = DiscoveryState(credits)
+        self.thread = None
+        self.handlers = {}
+        self.handlers_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def process_request(self, request, client_address):
+        ''' Like ThreadingMixIn's, but remembers the handler thread of each
+            connection so that stop() can wait for it
+        '''
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = self.daemon_threads
+        with self.handlers_lock:
+            self.handlers[thread] = request
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            with self.handlers_lock:
+                self.handlers.pop(threading.current_thread(), None)
+
+    def start(self):
+        ''' Serves requests in a background thread; returns the URL '''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        ''' Stops serving and waits for the handler threads to finish.
+            Connections kept alive between requests stop reading, so their
+            handlers return once any request in flight has been answered.
+        '''
+        self.shutdown()
+        if self.thread is not None:
+            self.thread.join()
+        with self.handlers_lock:
+            handlers = self.handlers.items()
+        for thread, request in handlers:
+            try:
+                request.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+        for thread, request in handlers:
+            thread.join()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8262
+    server = LocalDiscoveryServer(port)
+    print "Discovery stand-in listening on %s" % (server.url,)
+    server.serve_forever()
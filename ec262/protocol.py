@@ -1,59 +1,286 @@
+import time
+import asyncore
 import asynchat
-import pickle
+import socket
+import cPickle as pickle
+import cStringIO
+import struct
+import zlib
 import logging
+import settings
+
+# Binary frame header: flags, command length, payload length
+HEADER = struct.Struct('!BBQ')
+PICKLED = 1
+COMPRESSED = 2
 
 class Protocol(asynchat.async_chat):
+    """Sends and receives commands with optional pickled data
+
+    Connections start out with the text framing that every version of the
+    protocol understands. Peers that list a wire format in the options they
+    exchange when connecting switch to binary frames (see `wire_options`).
+
+    The command and data of a binary frame are received straight into a
+    buffer allocated from the length in its header, and unpickled from that
+    buffer. Outgoing messages are queued as memoryviews and sent in
+    `ac_out_buffer_size` pieces, so neither direction copies a payload.
+
+    For flow control, a connection is `congested` once more than
+    `high_water` bytes are waiting to be sent on it, until less than
+    `low_water` bytes are left, when `handle_drained` is called. It keeps
+    reading all along, so that two ends sending to each other can't both
+    stop; it's up to whatever produces the messages to hold off while the
+    connection is congested. `bytes_sent` and `bytes_received` count
+    what went through the socket, `decode_time` is how long the last
+    message received took to unpickle, and `encode_time` how long the last
+    message sent took to pickle and compress.
+    """
+    ac_in_buffer_size = 64 * 1024
+    ac_out_buffer_size = 64 * 1024
+    high_water = settings.FLOW_HIGH_WATER
+    low_water = settings.FLOW_LOW_WATER
+
     def __init__(self, conn=None):
         if conn:
             asynchat.async_chat.__init__(self, conn)
         else:
             asynchat.async_chat.__init__(self)
         self.set_terminator("\n")
-        self._buffer = ""
+        self._buffer = []
+        self._frame = None
+        self._frame_view = None
+        self._frame_received = 0
         self._mid_command = None
+        self._queued = 0
+        self.congested = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.decode_time = 0.0
+        self.encode_time = 0.0
         self._commands = {}
+        self.binary = False
+        self.pickle_protocol = 0
+        self.compress_threshold = None
         self.register_command('disconnect', lambda x, y: self.handle_close())
 
     def collect_incoming_data(self, data):
         """Receive data and append it to an internal buffer"""
-        self._buffer += data
+        self._buffer.append(data)
+
+    def push(self, data):
+        """Queue `data` to be sent without splitting (and copying) it"""
+        self.producer_fifo.append(memoryview(data))
+        self._queued += len(data)
+        if self._queued > self.high_water:
+            self.congested = True
+        self.initiate_send()
+        self.interest_changed()
+
+    def handle_drained(self):
+        """Called when a congested connection has sent enough to take
+        more messages
+        """
+        pass
+
+    def interest_changed(self):
+        """Tell the event loop that readable() or writable() changed"""
+        touch = getattr(self._map, 'touch', None)
+        if touch is not None and self._fileno is not None:
+            touch(self._fileno)
+
+    def initiate_send(self):
+        """Send as much of the first queued message as the socket takes"""
+        while self.producer_fifo and self.connected:
+            first = self.producer_fifo[0]
+            if not first:
+                del self.producer_fifo[0]
+                if first is None:
+                    self.handle_close()
+                    return
+                continue
+            try:
+                num_sent = self.send(first[:self.ac_out_buffer_size])
+            except socket.error:
+                self.handle_error()
+                return
+            if num_sent:
+                self.bytes_sent += num_sent
+                self._queued -= num_sent
+                if num_sent < len(first):
+                    self.producer_fifo[0] = first[num_sent:]
+                else:
+                    del self.producer_fifo[0]
+                if self.congested and self._queued < self.low_water:
+                    self.congested = False
+                    self.handle_drained()
+            return
+
+    def recv(self, buffer_size):
+        data = asynchat.async_chat.recv(self, buffer_size)
+        self.bytes_received += len(data)
+        return data
+
+    def handle_read(self):
+        """Read into the frame buffer if one is being received"""
+        if self._frame is None:
+            asynchat.async_chat.handle_read(self)
+            return
+        try:
+            received = self.socket.recv_into(
+                self._frame_view[self._frame_received:])
+        except socket.error, why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+            elif why.args[0] not in asynchat._BLOCKING_IO_ERRORS:
+                self.handle_error()
+            return
+        if not received:
+            self.handle_close()
+            return
+        self._frame_received += received
+        self.bytes_received += received
+        if self._frame_received == len(self._frame):
+            self._found_frame_body()
 
     def send_command(self, command, data=None):
         """Send command and optional data over connection
-        
-        Colons and newlines are special characters and should not appear in 
+
+        Colons and newlines are special characters and should not appear in
         `command`. If `data` is specified, then it will be pickled and sent
-        after `command`. The message sent is either `COMMAND:\\n` or
-        `COMMAND:DATALENGTH\\nPICKELED_DATA`
+        after `command`. With text framing, the message sent is either
+        `COMMAND:\\n` or `COMMAND:DATALENGTH\\nPICKELED_DATA`; with binary
+        framing it is a header packed with `HEADER`, then `COMMAND`, then
+        the (possibly compressed) pickled data.
         """
-        command += ':'
-        if data:
-            pdata = pickle.dumps(data)
-            self.push(command + str(len(pdata)) + '\n' + pdata)
+        start = time.time()
+        if not self.binary:
+            command += ':'
+            if data is not None:
+                pdata = pickle.dumps(data, self.pickle_protocol)
+                self.encode_time = time.time() - start
+                self.push(command + str(len(pdata)) + '\n' + pdata)
+            else:
+                self.encode_time = 0.0
+                self.push(command + "\n")
+            return
+        flags, pdata = 0, ''
+        if data is not None:
+            flags = PICKLED
+            pdata = pickle.dumps(data, self.pickle_protocol)
+            if (self.compress_threshold is not None and
+                len(pdata) > self.compress_threshold):
+                compressed = zlib.compress(pdata, 1)
+                if len(compressed) < len(pdata):
+                    flags, pdata = flags | COMPRESSED, compressed
+        self.encode_time = time.time() - start
+        header = HEADER.pack(flags, len(command), len(pdata)) + command
+        if len(pdata) < self.ac_out_buffer_size:
+            # Small payloads go out in the same segment as their header
+            self.push(header + pdata)
         else:
-            self.push(command + "\n")
+            self.push(header)
+            self.push(pdata)
 
     def found_terminator(self):
         """Process a received command
-        
+
         If a full command has been received, pass it to `process_command`;
         otherwise set `self.mid_command` and await the amount of data
-        specified by the 
+        specified by the header.
         """
-        if not self._mid_command:
-            command, data_length = self._buffer.split(":", 1)
+        message = ''.join(self._buffer)
+        self._buffer = []
+        if self.binary:
+            self._found_frame_header(message)
+        elif not self._mid_command:
+            command, data_length = message.split(":", 1)
             if data_length:
                 self.set_terminator(int(data_length))
                 self._mid_command = command
             else:
                 self.process_command(command)
         else:
-            data = pickle.loads(self._buffer)
-            self.set_terminator("\n")
+            start = time.time()
+            data = pickle.loads(message)
+            self.decode_time = time.time() - start
+            self.set_terminator(self._next_terminator())
             command = self._mid_command
             self._mid_command = None
             self.process_command(command, data)
-        self._buffer = ""
+
+    def _found_frame_header(self, header):
+        """Start receiving the command and data announced by `header`
+
+        Whatever asynchat has already read past the header is moved into
+        the frame buffer; the rest is read into it by `handle_read`.
+        """
+        flags, command_length, data_length = HEADER.unpack(header)
+        self._mid_command = (flags, command_length)
+        self._frame = bytearray(command_length + data_length)
+        self._frame_view = memoryview(self._frame)
+        received = min(len(self._frame), len(self.ac_in_buffer))
+        self._frame[:received] = self.ac_in_buffer[:received]
+        self.ac_in_buffer = self.ac_in_buffer[received:]
+        self._frame_received = received
+        # asynchat doesn't look at the socket again until the frame is done
+        self.set_terminator(None)
+        if received == len(self._frame):
+            self._found_frame_body()
+
+    def _found_frame_body(self):
+        """Process the command and data of a complete binary frame"""
+        flags, command_length = self._mid_command
+        frame = self._frame
+        self._mid_command = self._frame = self._frame_view = None
+        self.set_terminator(HEADER.size)
+        command = str(frame[:command_length])
+        data = None
+        if flags & PICKLED:
+            start = time.time()
+            pdata = buffer(frame, command_length)
+            if flags & COMPRESSED:
+                pdata = zlib.decompress(pdata)
+            data = pickle.load(cStringIO.StringIO(pdata))
+            self.decode_time = time.time() - start
+        self.process_command(command, data)
+
+    def _next_terminator(self):
+        return HEADER.size if self.binary else "\n"
+
+    def wire_options(self):
+        """Wire formats this end supports, to send when connecting"""
+        return {'binary': True, 'pickle': pickle.HIGHEST_PROTOCOL,
+                'compress': True}
+
+    def choose_wire_format(self, options, compress_threshold=None):
+        """Pick a wire format supported by both ends
+
+        `options` are the peer's `wire_options()`, or None for peers that
+        only support text framing. Returns the keyword arguments for
+        `set_wire_format`, or None to stay with text framing.
+        """
+        if not options or not options.get('binary'):
+            return None
+        if not options.get('compress'):
+            compress_threshold = None
+        return {
+            'pickle_protocol': min(options.get('pickle', 0),
+                                   pickle.HIGHEST_PROTOCOL),
+            'compress_threshold': compress_threshold,
+        }
+
+    def set_wire_format(self, pickle_protocol, compress_threshold=None):
+        """Switch to binary frames for everything sent and received next
+
+        Payloads are pickled with `pickle_protocol`, and compressed when
+        they are larger than `compress_threshold` bytes.
+        """
+        self.binary = True
+        self.pickle_protocol = pickle_protocol
+        self.compress_threshold = compress_threshold
+        if self._frame is None:
+            self.set_terminator(HEADER.size)
 
     def register_command(self, command, handler):
         """Register a handler for the given command"""
@@ -64,9 +291,9 @@ class Protocol(asynchat.async_chat):
         if command in self._commands:
             self._commands[command](command, data)
         else:
-            logging.critical("Unknown command received: %s" % (command,)) 
+            logging.critical("Unknown command received: %s" % (command,))
             self.handle_close()
-    
+
     def handle_close(self):
         """Handler for when connection should close"""
-        self.close()
\ No newline at end of file
+        self.close()
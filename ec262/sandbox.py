@@ -1,32 +1,185 @@
-import types, marshal
+import dis, sys, types, marshal, hashlib, collections
+import settings
 
 def freeze_function(f):
     return marshal.dumps(f.func_code)
+
+def code_hash(frozen_fn):
+    """Identify frozen code by its content, so it can be cached and offered
+    by hash instead of being sent again
+    """
+    return hashlib.sha1(frozen_fn).hexdigest()
+
+class LRUCache(object):
+    """A mapping that holds at most `size` entries, evicting the least
+    recently used one to make room
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+    
+def is_allowed(name, allowed_modules):
+    """Whether sandboxed code may import the module `name`
+    
+    Modules are allowed by their full name, so a submodule has to be listed
+    as well as its top-level package, which `import` returns. The packages
+    in between don't: sandboxed code can't reach them from the top-level
+    package unless they are listed too (see `module_view`).
+    """
+    if allowed_modules is None:
+        return True
+    return (name in allowed_modules and
+            name.split('.', 1)[0] in allowed_modules)
+
+# Views of modules for sandboxed code, by module name and allowed modules
+_views = {}
+
+def module_view(module, allowed_modules):
+    """A copy of `module` for sandboxed code to use
     
+    The modules that `module` imported are left out unless they are
+    allowed, in which case they are views themselves, and so are its
+    `__builtins__` and the attributes listed for it in
+    settings.DENIED_ATTRIBUTES. Only what the sandboxed code reaches
+    through module attributes is filtered: objects it gets from the module
+    still lead to the real one, by their functions' globals for instance.
+    """
+    key = (module.__name__, allowed_modules)
+    view = _views.get(key)
+    if view is not None:
+        return view
+    view = _views[key] = types.ModuleType(module.__name__)
+    denied = settings.DENIED_ATTRIBUTES.get(module.__name__, ())
+    for name, value in vars(module).items():
+        if name == '__builtins__' or name in denied:
+            continue
+        if isinstance(value, types.ModuleType):
+            if not is_allowed(value.__name__, allowed_modules):
+                continue
+            value = module_view(value, allowed_modules)
+        setattr(view, name, value)
+    return view
+
+def _graft(name, allowed_modules):
+    """Add the module `name` to the view of its package, in case it was
+    imported after the view was made
+    """
+    package, _, child = name.rpartition('.')
+    if (package and name in sys.modules and
+        is_allowed(name, allowed_modules)):
+        setattr(module_view(sys.modules[package], allowed_modules), child,
+                module_view(sys.modules[name], allowed_modules))
+
 def gen_custom_import(allowed_modules):
+    if allowed_modules is not None:
+        allowed_modules = frozenset(allowed_modules)
+    # Modules already granted to this function: by name for `import x`, and
+    # by name and fromlist for `from x import y`, which return different
+    # modules for dotted names
+    granted = {}
     def custom_import(name, _globals=None, _locals=None, fromlist=None, level=-1):
         """Prevent the import of disallowed modules"""
+        key = (name, tuple(fromlist)) if fromlist else name
+        module = granted.get(key)
+        if module is not None:
+            return module
         if fromlist is None:
             fromlist = []
         if _locals is None:
             _locals = {}
         if _globals is None:
             _globals = {}
-        if allowed_modules is None or name in allowed_modules:
-            return __import__(name, _globals, _locals, fromlist, level)
-        else:
+        if not is_allowed(name, allowed_modules):
             raise Exception('Nuh uh Mr. Burrito man!')
+        module = __import__(name, _globals, _locals, fromlist, level)
+        if allowed_modules is not None:
+            parts = name.split('.')
+            for i in xrange(2, len(parts) + 1):
+                _graft('.'.join(parts[:i]), allowed_modules)
+            for item in fromlist:
+                _graft(module.__name__ + '.' + item, allowed_modules)
+            module = module_view(module, allowed_modules)
+        granted[key] = module
+        return module
     return custom_import
 
+def imported_names(code):
+    """The names of the modules that `code`, or code nested in it, imports"""
+    names = set()
+    ops, i, extended = code.co_code, 0, 0
+    while i < len(ops):
+        op = ord(ops[i])
+        if op < dis.HAVE_ARGUMENT:
+            i += 1
+            continue
+        arg = ord(ops[i + 1]) + ord(ops[i + 2]) * 256 + extended
+        extended = arg << 16 if op == dis.EXTENDED_ARG else 0
+        if op == IMPORT_NAME:
+            names.add(code.co_names[arg])
+        i += 3
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(imported_names(const))
+    return names
+
+IMPORT_NAME = dis.opmap['IMPORT_NAME']
+
 def unfreeze_and_sandbox_function(frozen_fn, name, allowed_modules=None):
     disallowed_builtins = ['eval', 'execfile', 'open', 'print', 'raw_input', 'reload']
     _globals = globals()
     _builtins = dict(_globals['__builtins__'])
     for prop in disallowed_builtins:
        del _builtins[prop]
-    _builtins['__import__'] = gen_custom_import(allowed_modules)
+    custom_import = gen_custom_import(allowed_modules)
+    _builtins['__import__'] = custom_import
     gs = {
         '__builtins__': _builtins,
         '__file__': None, '__name__': None, '__doc__': None,
     }
-    return types.FunctionType(marshal.loads(frozen_fn), gs, name)
\ No newline at end of file
+    code = marshal.loads(frozen_fn)
+    # Import the allowed modules the function uses now, so that calls only
+    # look them up; the others still fail when the function gets to them
+    for module in imported_names(code):
+        if not is_allowed(module, allowed_modules):
+            continue
+        try:
+            custom_import(module)
+        except ImportError:
+            pass
+    return types.FunctionType(code, gs, name)
+
+def load_function(cache, frozen_fn, name, allowed_modules=None, digest=None):
+    """Unfreeze and sandbox a function, or reuse it from `cache`
+    
+    Functions are keyed by the hash of their code (`digest`, if it is
+    already known), their name and the modules they may import, since all
+    three go into the sandboxed function.
+    """
+    if allowed_modules is not None:
+        allowed_modules = frozenset(allowed_modules)
+    key = (digest or code_hash(frozen_fn), name, allowed_modules)
+    fn = cache.get(key)
+    if fn is None:
+        fn = unfreeze_and_sandbox_function(frozen_fn, name, allowed_modules)
+        cache.put(key, fn)
+    return fn
\ No newline at end of file
@@ -0,0 +1,167 @@
+import time
+import bisect
+import collections
+import settings
+
+class LatencyStats(object):
+    """The latencies of the tasks of a job, in seconds, for percentiles"""
+
+    def __init__(self):
+        self.samples = []
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, latency):
+        bisect.insort(self.samples, latency)
+
+    def percentile(self, p):
+        """The `p`th percentile of the latencies, or None if there are none"""
+        if not self.samples:
+            return None
+        index = int(round(p / 100.0 * (len(self.samples) - 1)))
+        return self.samples[index]
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """A dictionary of the given percentiles and the number of tasks"""
+        summary = dict(('p%d' % p, self.percentile(p)) for p in percentiles)
+        summary['count'] = len(self.samples)
+        return summary
+
+
+class Scheduler(object):
+    """Keeps track of which tasks are waiting, running and complete
+
+    Waiting tasks are handed out in FIFO order. A task stays in the queue for
+    as long as it is waiting, so a repeated task is handed to several workers
+    before the tasks behind it. Running tasks are indexed by worker, which
+    lets the scheduler avoid giving a worker a task it already holds.
+
+    With `multiple` set, tasks that have been running for more than
+    `multiple` times the median latency of the tasks before them are
+    stragglers, and idle workers run a copy of them, up to `copies` copies
+    each. Nothing is a straggler until `min_samples` tasks have completed.
+    """
+
+    def __init__(self, multiple=None, copies=settings.SPECULATIVE_COPIES,
+                 min_samples=settings.SPECULATION_MIN_SAMPLES):
+        self.waiting = collections.OrderedDict()
+        self.requeued = collections.deque()
+        self.running = {}
+        self.added = 0
+        self.completed = 0
+        self.multiple = multiple
+        self.copies = copies
+        self.min_samples = min_samples
+        self.latencies = LatencyStats()
+        # Tasks that are running, oldest last dispatch first
+        self.dispatched = collections.OrderedDict()
+        self.speculated = collections.Counter()
+
+    def add(self, task):
+        """Queue a new task"""
+        self.waiting[task] = True
+        self.added += 1
+
+    def next(self, worker=None):
+        """Return the oldest waiting task that `worker` isn't running
+
+        Returns None if there is no such task. Tasks already held by
+        `worker`, or that it can't run (a replica it already ran, or any
+        task if the ledger doesn't trust it), are skipped one by one, so
+        this is O(1) with a single replica but O(waiting) with replicas or
+        spot checks. Tasks are only created as workers need them, which
+        keeps the waiting queue to about the tasks in flight.
+        """
+        held = self.running.get(worker, ())
+        for i in xrange(len(self.requeued)):
+            task = self.requeued.popleft()
+            if task.state == task.COMPLETE:
+                continue
+            if task in held or not task.assignable(worker):
+                self.requeued.append(task)
+                continue
+            return task
+        for task in self.waiting:
+            if task not in held and task.assignable(worker):
+                return task
+        return None
+
+    def update(self, task):
+        """Called when the state of `task` changes"""
+        if task.state != task.WAITING:
+            self.waiting.pop(task, None)
+        if task.state == task.COMPLETE:
+            self.completed += 1
+            self.dispatched.pop(task, None)
+            self.speculated.pop(task, None)
+
+    def assign(self, task, worker):
+        """Record that `worker` is running `task`"""
+        self.running.setdefault(worker, set()).add(task)
+        self.dispatched.pop(task, None)
+        self.dispatched[task] = time.time()
+
+    def record(self, latency):
+        """Record that a worker took `latency` seconds to return a task"""
+        self.latencies.add(latency)
+
+    def release(self, task, worker):
+        """Record that `worker` is no longer running `task`"""
+        held = self.running.get(worker)
+        if held is not None:
+            held.discard(task)
+            if not held:
+                del self.running[worker]
+
+    def requeue(self, task):
+        """Hand `task` out again before any waiting task
+
+        This is how tasks that need another replica get one, because a
+        worker went away or replicas disagreed: the task is given to the
+        next worker that asks for work and may run it. Stragglers don't go
+        through here; see `straggler`.
+        """
+        self.requeued.append(task)
+
+    def reopen(self, task):
+        """Queue a task that was complete again, like a new task"""
+        self.completed -= 1
+        self.waiting[task] = True
+
+    def straggler(self, worker):
+        """Return a running task that `worker` should also run, or None
+
+        Called when there is nothing left to hand out but some tasks are
+        still running. Tasks are checked from the longest running, so this
+        stops at the first one that isn't a straggler. Only running tasks
+        are copied: a task waiting for a replica is already handed out to
+        the next worker that may run it, and one that no worker left may
+        run makes do without it (see Job.limit_replicas).
+        """
+        if self.multiple is None or len(self.latencies) < self.min_samples:
+            return None
+        threshold = self.multiple * self.latencies.percentile(50)
+        now = time.time()
+        held = self.running.get(worker, ())
+        for task, dispatched in self.dispatched.iteritems():
+            if now - dispatched < threshold:
+                break
+            if (task.state != task.RUNNING or task in held or
+                self.speculated[task] >= self.copies or
+                not task.assignable(worker)):
+                continue
+            self.speculated[task] += 1
+            return task
+        return None
+
+    def tasks(self):
+        """The tasks that have been added but aren't complete"""
+        tasks = list(self.dispatched)
+        tasks.extend(task for task in self.waiting
+                     if task not in self.dispatched)
+        return tasks
+
+    def pending(self):
+        """Number of tasks that have been added but aren't complete"""
+        return self.added - self.completed
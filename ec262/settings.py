@@ -2,3 +2,102 @@ VERSION = "0.1.2"
 DEFAULT_PORT = 11235
 DISCOVERY_SERVICE_URL = "http://ec262discovery.herokuapp.com/"
 DEFAULT_TTL = 60
+
+# Discovery service requests: (connect, read) timeout in seconds, number of
+# retries for failed connections, and number of pooled connections
+DISCOVERY_TIMEOUT = (3.05, 10)
+DISCOVERY_RETRIES = 3
+DISCOVERY_POOL_SIZE = 8
+
+# Connections a worker's listening socket queues before accepting them
+LISTEN_BACKLOG = 128
+
+# How the event loop waits for sockets: 'epoll', 'poll' or 'select'
+EVENT_LOOP = 'epoll'
+
+# The foreman stops sending tasks on a connection once more than
+# FLOW_HIGH_WATER bytes are waiting to be sent on it, and starts again
+# below FLOW_LOW_WATER bytes
+FLOW_HIGH_WATER = 16 * 2 ** 20
+FLOW_LOW_WATER = 4 * 2 ** 20
+
+# Payloads larger than this many bytes are compressed when both ends of a
+# connection support it; None turns compression off
+COMPRESS_THRESHOLD = 64 * 1024
+
+# Every task is sent to REPLICAS workers and completes once QUORUM of them
+# agree on the result. Tasks whose replicas disagree are sent out again, to
+# no more than MAX_REPLICAS workers in all
+REPLICAS = 4
+QUORUM = 3
+MAX_REPLICAS = 8
+
+# With spot checks instead, tasks run on one worker and are checked on
+# another with probability SPOT_CHECK_RATE. Each check a worker fails or
+# disputes multiplies its rate by SPOT_CHECK_ESCALATION, and a worker that
+# fails SPOT_CHECK_STRIKES checks is treated as dishonest
+SPOT_CHECK_RATE = 0.1
+SPOT_CHECK_ESCALATION = 4.0
+SPOT_CHECK_STRIKES = 2
+
+# Modules that map and reduce functions may import, by their full names: a
+# submodule is only allowed if it is listed too. None allows any module
+ALLOWED_MODULES = ('time', 'math', 'cmath', 'random', 're', 'string',
+                   'collections', 'itertools', 'functools', 'operator',
+                   'heapq', 'bisect', 'array', 'struct', 'json', 'datetime',
+                   'decimal', 'fractions', 'numpy', 'numpy.linalg',
+                   'numpy.fft', 'numpy.random',
+                   # imported by numpy's C code for array methods and dtypes
+                   'numpy.core._methods', 'numpy.core._dtype')
+
+# Attributes of allowed modules that map and reduce functions don't get,
+# by module; they read or write files or unpickle data
+DENIED_ATTRIBUTES = {
+    'numpy': ('DataSource', 'fromfile', 'fromregex', 'genfromtxt', 'load',
+              'loads', 'loadtxt', 'mafromtxt', 'memmap', 'ndfromtxt',
+              'recfromcsv', 'recfromtxt', 'save', 'savetxt', 'savez',
+              'savez_compressed'),
+}
+
+# Upper bounds in seconds of the buckets of the task span histograms
+TRACE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Sandboxed functions cached by each process that runs tasks, and frozen
+# code cached by each worker so foremen only have to send code it hasn't seen
+FUNCTION_CACHE_SIZE = 64
+CODE_CACHE_SIZE = 256
+
+# The foreman groups map output by key in memory until it takes about
+# SHUFFLE_MEMORY_BUDGET bytes, then spills it to a sorted run in a temporary
+# file in SHUFFLE_DIR (None for the system default). Runs are merged as the
+# reduce phase reads them, and into one whenever there are SHUFFLE_MAX_RUNS
+SHUFFLE_MEMORY_BUDGET = 256 * 2 ** 20
+SHUFFLE_DIR = None
+SHUFFLE_MAX_RUNS = 64
+
+# Map output is split by key hash into SHUFFLE_PARTITIONS partitions. When
+# the reducer is also the combiner, workers left idle by the last map tasks
+# reduce any partition holding more than PARTIAL_REDUCE_BYTES in memory
+SHUFFLE_PARTITIONS = 16
+PARTIAL_REDUCE_BYTES = 2 ** 20
+
+# Speculative execution: a task still running SPECULATION_MULTIPLE times
+# longer than the median task (None to turn this off) is also sent to an idle
+# worker, up to SPECULATIVE_COPIES more times, once SPECULATION_MIN_SAMPLES
+# tasks have completed. Whichever result is verified first is used
+SPECULATION_MULTIPLE = 3.0
+SPECULATIVE_COPIES = 1
+SPECULATION_MIN_SAMPLES = 5
+
+# Seconds between the foreman's checks for stragglers and for workers left
+# connected after a job, when no result comes in to wake it
+TICK_INTERVAL = 1.0
+
+# Adaptive chunking: chunks are resized so that a task takes about
+# CHUNK_TARGET_TIME seconds and pickles to about CHUNK_TARGET_BYTES bytes,
+# staying within [MIN_CHUNK_ROWS, MAX_CHUNK_ROWS] rows
+CHUNK_TARGET_TIME = 1.0
+CHUNK_TARGET_BYTES = 256 * 1024
+MIN_CHUNK_ROWS = 1
+MAX_CHUNK_ROWS = 10000
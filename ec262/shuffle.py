@@ -0,0 +1,390 @@
+import sys
+import zlib
+import heapq
+import logging
+import tempfile
+import operator
+import itertools
+import cPickle
+import marshal
+import settings
+
+def partition(key, partitions):
+    """The partition of `partitions` that `key` belongs to
+    
+    This is the same on every machine, unlike `hash()`, which depends on
+    the platform.
+    """
+    return (zlib.crc32(marshal.dumps(key, 0)) & 0xffffffff) % partitions
+
+def batch_pairs(output):
+    """The (key, value) pairs of the output of a batch function
+    
+    Batch functions return a sequence of keys and a sequence of values of
+    the same length. Either can be an array with a `tolist()` method, like
+    a NumPy array, which is turned into a list of plain Python values.
+    """
+    keys, values = output
+    if hasattr(keys, 'tolist'):
+        keys = keys.tolist()
+    if hasattr(values, 'tolist'):
+        values = values.tolist()
+    if len(keys) != len(values):
+        raise ValueError("A batch function returned %d keys and %d values" %
+                         (len(keys), len(values)))
+    return itertools.izip(keys, values)
+
+def split(data, partitions):
+    """Split the dictionary `data` into a dictionary for each non-empty
+    partition, keyed by partition number
+    """
+    parts = {}
+    for key, value in data.iteritems():
+        index = partition(key, partitions)
+        part = parts.get(index)
+        if part is None:
+            parts[index] = part = {}
+        part[key] = value
+    return parts
+
+class ShuffleBuffer(object):
+    """Groups intermediate values by key as they are emitted
+    
+    Values for each key are appended to a list, so adding a value costs the
+    same however often its key has been seen. `materialize()` turns the
+    lists into tuples once, when the grouped output is needed.
+    """
+    
+    def __init__(self):
+        self.values = {}
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def add(self, key, value):
+        """Append a single value for `key`"""
+        values = self.values.get(key)
+        if values is None:
+            self.values[key] = [value]
+        else:
+            values.append(value)
+    
+    def add_pairs(self, pairs):
+        """Append the value of each (key, value) pair"""
+        for key, value in pairs:
+            self.add(key, value)
+    
+    def extend(self, key, values):
+        """Append a sequence of values for `key`"""
+        existing = self.values.get(key)
+        if existing is None:
+            self.values[key] = list(values)
+        else:
+            existing.extend(values)
+    
+    def update(self, data):
+        """Append the values of a dictionary mapping keys to sequences"""
+        for key, values in data.iteritems():
+            self.extend(key, values)
+    
+    def combine(self, combinefn, batch=False):
+        """Replace the values of each key with the output of `combinefn`
+        
+        `combinefn` is called like a reducer, with a key and a tuple of its
+        values, and yields (key, value) pairs. With `batch` set, it is
+        called once with a list of every key and a list of their tuples of
+        values instead, and returns keys and values (see `batch_pairs`).
+        """
+        combined = ShuffleBuffer()
+        if batch:
+            keys = list(self.values)
+            output = combinefn(keys, [tuple(self.values[key])
+                                      for key in keys])
+            combined.add_pairs(batch_pairs(output))
+        else:
+            for key, values in self.values.iteritems():
+                for key, value in combinefn(key, tuple(values)):
+                    combined.add(key, value)
+        self.values = combined.values
+    
+    def materialize(self):
+        """Return a dictionary mapping each key to a tuple of its values"""
+        return dict((key, tuple(values))
+                    for key, values in self.values.iteritems())
+
+
+class ExternalShuffleBuffer(ShuffleBuffer):
+    """A ShuffleBuffer that spills to disk to stay within a memory budget
+    
+    Once the values held in memory take about `memory_budget` bytes (an
+    estimate, from the shallow size of each key and value; None for no
+    limit), they are sorted by key and written to a temporary file in
+    `directory` as a run, and the buffer starts over. `iteritems()` merges
+    the runs and what is left in memory a key at a time, so the grouped
+    output never has to fit in memory. Once there are `max_runs` runs they
+    are merged into one, so reading them doesn't hold too many files open.
+    
+    The temporary files are deleted by `close()`, or when the process exits.
+    """
+    # Estimated bytes for a key's dictionary entry and list of values, and
+    # for each value's slot in that list, on top of their own sizes
+    KEY_OVERHEAD = 112
+    VALUE_OVERHEAD = 8
+    # Number of (key, values) pairs pickled at a time in a run
+    BATCH_SIZE = 1024
+    
+    def __init__(self, memory_budget=settings.SHUFFLE_MEMORY_BUDGET,
+                 directory=settings.SHUFFLE_DIR,
+                 max_runs=settings.SHUFFLE_MAX_RUNS):
+        ShuffleBuffer.__init__(self)
+        self.memory_budget = memory_budget
+        self.directory = directory
+        self.max_runs = max(2, max_runs)
+        self.size = 0
+        self.runs = []
+        self.spilled = 0
+    
+    def add(self, key, value):
+        values = self.values.get(key)
+        if values is None:
+            self.values[key] = [value]
+            self.size += self.KEY_OVERHEAD + sys.getsizeof(key)
+        else:
+            values.append(value)
+        self.size += self.VALUE_OVERHEAD + sys.getsizeof(value)
+        if self.memory_budget is not None and self.size > self.memory_budget:
+            self.spill()
+    
+    def extend(self, key, values):
+        existing = self.values.get(key)
+        if existing is None:
+            self.values[key] = list(values)
+            self.size += self.KEY_OVERHEAD + sys.getsizeof(key)
+        else:
+            existing.extend(values)
+        self.size += (self.VALUE_OVERHEAD * len(values) +
+                      sum(itertools.imap(sys.getsizeof, values)))
+        if self.memory_budget is not None and self.size > self.memory_budget:
+            self.spill()
+    
+    def spill(self):
+        """Write the values in memory to a new run and clear them"""
+        if not self.values:
+            return
+        values = self.values
+        self.runs.append(self._write_run((key, values[key])
+                                         for key in sorted(values)))
+        self.values = {}
+        self.size = 0
+        if len(self.runs) >= self.max_runs:
+            runs, self.runs = self.runs, []
+            self.runs.append(self._write_run(self._merge(runs)))
+            for run in runs:
+                run.close()
+        logging.debug("Spilled map output to run %d (%d bytes on disk)" %
+                      (len(self.runs), self.spilled))
+    
+    def drain(self):
+        """Remove the values held in memory and return them as a dictionary
+        of lists, leaving the runs
+        """
+        values, self.values = self.values, {}
+        self.size = 0
+        return values
+    
+    def iteritems(self):
+        """Yield each key with a tuple of its values
+        
+        Keys come out in sorted order if anything was spilled, and in no
+        particular order otherwise.
+        """
+        if not self.runs:
+            for key, values in self.values.iteritems():
+                yield key, tuple(values)
+            return
+        buffered = self.values
+        in_memory = ((key, buffered[key]) for key in sorted(buffered))
+        for key, values in self._merge(self.runs, in_memory):
+            yield key, tuple(values)
+    
+    def materialize(self):
+        return dict(self.iteritems())
+    
+    def close(self):
+        """Delete the runs"""
+        for run in self.runs:
+            run.close()
+        self.runs = []
+    
+    def _write_run(self, pairs):
+        """Write (key, values) pairs sorted by key to a temporary file"""
+        run = tempfile.TemporaryFile(prefix='ec262-shuffle-',
+                                     dir=self.directory)
+        pickler = cPickle.Pickler(run, cPickle.HIGHEST_PROTOCOL)
+        # Pickles refer back to objects they've seen, which would keep every
+        # batch alive until the run is written
+        pickler.fast = True
+        while True:
+            batch = list(itertools.islice(pairs, self.BATCH_SIZE))
+            if not batch:
+                break
+            pickler.dump(batch)
+        self.spilled += run.tell()
+        return run
+    
+    def _read_run(self, run, number):
+        """Yield the (key, number, values) entries of a run
+        
+        `number` breaks ties between runs, so the values of a key are never
+        compared and come out in the order their runs were written.
+        """
+        run.seek(0)
+        load = cPickle.Unpickler(run).load
+        while True:
+            try:
+                batch = load()
+            except EOFError:
+                return
+            for key, values in batch:
+                yield key, number, values
+    
+    def _merge(self, runs, in_memory=()):
+        """Merge sorted runs into (key, values) pairs with a k-way merge"""
+        streams = [self._read_run(run, i) for i, run in enumerate(runs)]
+        streams.append((key, len(runs), values) for key, values in in_memory)
+        for key, entries in itertools.groupby(
+                heapq.merge(*streams), operator.itemgetter(0)):
+            values = []
+            for entry in entries:
+                values.extend(entry[2])
+            yield key, values
+
+
+class PartitionedShuffle(object):
+    """Map output split by key into `partitions` ExternalShuffleBuffers
+    
+    Each key goes to the partition `partition(key, partitions)`. The
+    partitions share `memory_budget`: once the values they hold in memory
+    take more than that, the largest are spilled until half of it is free.
+    A partition can be drained on its own, to reduce it before the rest of
+    the output is in, and `iteritems()` reads the partitions one after
+    another, so only one partition's runs are merged at a time.
+    """
+    
+    def __init__(self, partitions=settings.SHUFFLE_PARTITIONS,
+                 memory_budget=settings.SHUFFLE_MEMORY_BUDGET,
+                 directory=settings.SHUFFLE_DIR,
+                 max_runs=settings.SHUFFLE_MAX_RUNS):
+        self.memory_budget = memory_budget
+        self.partitions = [ExternalShuffleBuffer(None, directory, max_runs)
+                           for i in xrange(max(1, partitions))]
+        self.size = 0
+    
+    def add(self, key, value):
+        """Append a single value for `key`"""
+        buf = self.partitions[partition(key, len(self.partitions))]
+        size = buf.size
+        buf.add(key, value)
+        self.size += buf.size - size
+        if self.size > self.memory_budget:
+            self.spill()
+    
+    def extend(self, key, values):
+        """Append a sequence of values for `key`"""
+        buf = self.partitions[partition(key, len(self.partitions))]
+        size = buf.size
+        buf.extend(key, values)
+        self.size += buf.size - size
+        if self.size > self.memory_budget:
+            self.spill()
+    
+    def update(self, data):
+        """Append the values of a dictionary mapping keys to sequences"""
+        for key, values in data.iteritems():
+            self.extend(key, values)
+    
+    def spill(self):
+        """Spill the largest partitions until half the budget is free"""
+        while self.size > self.memory_budget / 2:
+            buf = self.partitions[self.largest()]
+            if not buf.values:
+                break
+            self.size -= buf.size
+            buf.spill()
+    
+    def largest(self):
+        """The index of the partition with the most values in memory"""
+        return max(xrange(len(self.partitions)),
+                   key=lambda i: self.partitions[i].size)
+    
+    def drain(self, index):
+        """Remove the values partition `index` holds in memory and return
+        them as a dictionary of lists
+        """
+        buf = self.partitions[index]
+        self.size -= buf.size
+        return buf.drain()
+    
+    def iteritems(self):
+        """Yield each key with a tuple of its values, a partition at a time"""
+        for buf in self.partitions:
+            for pair in buf.iteritems():
+                yield pair
+    
+    def materialize(self):
+        return dict(self.iteritems())
+    
+    @property
+    def runs(self):
+        return [run for buf in self.partitions for run in buf.runs]
+    
+    def close(self):
+        """Delete the runs of every partition"""
+        for buf in self.partitions:
+            buf.close()
+
+
+class PartitionTable(object):
+    """Where each partition of the map output is, when workers shuffle it
+    
+    Instead of their output, map tasks return the digest of each partition
+    of it (see `split`), and keep the partitions to serve to other workers.
+    Each entry added is a (key, digests, holders) triple: the key the
+    workers store the task's output under, the digest of each non-empty
+    partition, and the addresses of the workers that agreed on them.
+    `iteritems()` yields each partition with the (key, digest, holders) of
+    every piece of it, which is what a reduce task needs to fetch it.
+    """
+    
+    def __init__(self, partitions=settings.SHUFFLE_PARTITIONS):
+        self.sources = [[] for i in xrange(max(1, partitions))]
+        self.entries = {}
+    
+    def add(self, entry):
+        key, digests, holders = entry
+        self.entries[key] = (digests, holders)
+        for index, digest in digests.iteritems():
+            self.sources[index].append((key, digest, holders))
+    
+    def move(self, entry):
+        """Make the holders of an entry added before the ones in `entry`
+        
+        The pieces listed for reduce tasks share their holders, so those
+        not yet sent are fetched from the new ones. Returns False, and
+        changes nothing, if the digests differ from those added.
+        """
+        key, digests, holders = entry
+        old_digests, old_holders = self.entries[key]
+        if digests != old_digests:
+            return False
+        old_holders[:] = holders
+        return True
+    
+    def iteritems(self):
+        for index, sources in enumerate(self.sources):
+            if sources:
+                yield index, sources
+    
+    def close(self):
+        self.sources = []
+        self.entries = {}
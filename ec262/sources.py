@@ -0,0 +1,60 @@
+import os
+import mmap
+import itertools
+
+def iterpairs(source):
+    """Iterate over the (key, value) pairs of a data source
+
+    A source is a dictionary, or anything else with an `iteritems()` method
+    (like LineFileSource), or an iterable of (key, value) pairs, such as a
+    generator. Only dictionaries have to fit in memory.
+    """
+    if hasattr(source, 'iteritems'):
+        return source.iteritems()
+    return iter(source)
+
+def rereadable(source):
+    """Whether `iterpairs` reads `source` from the start every time
+
+    Iterators, like generators, can only be read once.
+    """
+    return hasattr(source, 'iteritems') or iter(source) is not source
+
+def readpairs(source, start, rows):
+    """Read the `rows` pairs of `source` from the `start`th one on again
+
+    The source is read from the start, so this is for rare cases like
+    running a task again, not for reading chunks as a job goes.
+    """
+    return tuple(itertools.islice(iterpairs(source), start, start + rows))
+
+
+class LineFileSource(object):
+    """The lines of a file, keyed by the byte offset where each one starts
+
+    The file is mapped into memory with mmap rather than read, so the
+    operating system pages it in and out as it is scanned, and a file
+    larger than memory can be processed. Lines keep their newline, like
+    `file.readlines()`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def iteritems(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start, size = 0, data.size()
+                while start < size:
+                    end = data.find('\n', start)
+                    end = size if end < 0 else end + 1
+                    yield start, data[start:end]
+                    start = end
+            finally:
+                data.close()
+
+    def __iter__(self):
+        return self.iteritems()
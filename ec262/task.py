@@ -1,25 +1,95 @@
 import itertools
+import collections
 import random
 import uuid
+import time
 import logging
+import traceback
+import cPickle
+import canonical
+import settings
+from scheduler import Scheduler
+from sources import iterpairs, rereadable, readpairs
+from trust import TrustLedger
+from shuffle import PartitionedShuffle, PartitionTable
+
+class TaskFailed(Exception):
+    """A task failed in a way that running it again won't fix; the message
+    is the traceback of the error
+    """
 
 class DataChunker(object):
-    """Class that allows us to iterate through data with dynamic chunking"""
+    """Class that allows us to iterate through data with dynamic chunking
+    
+    The data can be any source that `sources.iterpairs` accepts, and is
+    read one chunk at a time.
     
-    def __init__(self, datasource, rows=1):
+    If `adaptive` is set, the number of rows per chunk is recomputed every
+    time a completion time is passed to `record()`, so that a chunk takes
+    about `target_time` seconds to process and pickles to about
+    `target_bytes` bytes. The chunk size always stays within
+    [`min_rows`, `max_rows`].
+    """
+    # Weight of the newest sample in the per-row moving averages
+    SMOOTHING = 0.3
+    # Largest factor the chunk size can grow by after a single sample
+    MAX_GROWTH = 2.0
+    
+    def __init__(self, datasource, rows=1, adaptive=False,
+                 min_rows=settings.MIN_CHUNK_ROWS,
+                 max_rows=settings.MAX_CHUNK_ROWS,
+                 target_time=settings.CHUNK_TARGET_TIME,
+                 target_bytes=settings.CHUNK_TARGET_BYTES):
         self.data = datasource
+        self.adaptive = adaptive
+        self.min_rows = max(1, min_rows)
+        self.max_rows = max(self.min_rows, max_rows)
+        self.target_time = target_time
+        self.target_bytes = target_bytes
+        self.time_per_row = None
+        self.bytes_per_row = None
         self.rows = rows
+        if adaptive:
+            self.set_rows(rows)
         self.done = False
     
     def set_rows(self, rows):
         """Set the number of rows to send at a time"""
+        if self.adaptive:
+            rows = min(max(int(rows), self.min_rows), self.max_rows)
         self.rows = rows
     
+    def record(self, rows, elapsed):
+        """Record that a chunk of `rows` rows took `elapsed` seconds"""
+        if not self.adaptive or rows <= 0:
+            return
+        self.time_per_row = self._average(self.time_per_row,
+                                          float(elapsed) / rows)
+        limit = self.max_rows
+        if self.time_per_row > 0:
+            limit = min(limit, self.target_time / self.time_per_row)
+        if self.bytes_per_row:
+            limit = min(limit, self.target_bytes / self.bytes_per_row)
+        self.set_rows(min(limit, self.rows * self.MAX_GROWTH))
+    
+    def _average(self, average, sample):
+        """Exponential moving average of the samples seen so far"""
+        if average is None:
+            return sample
+        return self.SMOOTHING * sample + (1 - self.SMOOTHING) * average
+    
+    def _sample_size(self, data):
+        """Estimate the pickled size of a row from the first row of a chunk"""
+        size = len(cPickle.dumps(data[0], cPickle.HIGHEST_PROTOCOL))
+        self.bytes_per_row = self._average(self.bytes_per_row, size)
+    
     def __iter__(self):
         """Iterator for returning data chunks of the appropriate length"""
-        it = self.data.iteritems()
+        it = iterpairs(self.data)
         data = tuple(itertools.islice(it, self.rows))
         while len(data) > 0:
+            if self.adaptive:
+                self._sample_size(data)
             yield data
             data = tuple(itertools.islice(it, self.rows))
         self.done = True
@@ -33,20 +103,32 @@ class Task(object):
     
     def __init__(self, *args, **kwargs):
         self.id = uuid.uuid4()
+        self.job = None
+        self.index = None
         self._state = None
         self.state = Task.WAITING
         self.result = None
         self.workers = set()
+        self.started = {}
+        self.shuffle = None
     
     def add_worker(self, worker):
         """Add a worker to work on the task"""
         self.workers.add(worker)
+        self.started[worker] = time.time()
+        if self.job is not None:
+            self.job.task_assigned(self, worker)
         self.handle_worker(worker)
         if self.is_running():
             self.state = Task.RUNNING
     
-    def complete(self, worker, result):
-        """Mark the task as complete"""
+    def complete(self, worker, result, elapsed=None, digest=None):
+        """Mark the task as complete
+        
+        `digest` is set instead of `result` when the worker was only asked
+        for the digest of its result.
+        """
+        self.worker_done(worker, elapsed)
         if self.state != Task.COMPLETE and self.is_complete(worker, result):
             self.result = (worker, result)
             self.state = Task.COMPLETE
@@ -60,20 +142,59 @@ class Task(object):
                 self.handle_running()
             elif state == Task.COMPLETE:
                 self.handle_complete()
+            if self.job is not None:
+                self.job.task_updated(self)
     
     def get_state(self):
         return self._state
     
     state = property(get_state, set_state)
     
+    def worker_done(self, worker, elapsed=None):
+        """Report how long `worker` took to the job that owns this task
+        
+        If the worker didn't say how long it took, this is the time since
+        the task was sent to it, which is also reported as the latency.
+        """
+        started = self.started.pop(worker, None)
+        latency = None
+        if started is not None:
+            latency = time.time() - started
+        if elapsed is None:
+            elapsed = latency
+        if self.job is not None and elapsed is not None:
+            self.job.task_done(self, worker, elapsed, latency)
+    
+    def worker_lost(self, worker, requeue=True):
+        """Called when `worker` goes away before returning a result
+        
+        Tasks that replace the lost worker only hand themselves out again
+        with `requeue` set; otherwise whoever unset it requeues them.
+        """
+        self.started.pop(worker, None)
+        if self.job is not None:
+            self.job.task_cancelled(self, worker)
+    
+    def limit_replicas(self, workers):
+        """Called when workers went away, leaving only `workers`"""
+        pass
+    
     def is_running(self):
         """Test to see if the task is currently running"""
         return len(self.workers) > 0
     
+    def assignable(self, worker):
+        """Test to see if `worker` may be given the task"""
+        return True
+    
     def is_complete(self, worker, result):
         """Test to see if the task has been completed"""
         return True
     
+    def is_final(self):
+        """Test to see if the result, once complete, can no longer change"""
+        return True
+    
     def handle_worker(self, worker):
         pass
     def handle_waiting(self):
@@ -94,8 +215,8 @@ class CommandTask(Task):
     
     def handle_worker(self, worker):
         """Run the command by having the worker send it out"""
-        logging.debug("SEND_COMMAND: ", self.command, self.data)
-        worker.send_command(self.command, self.data)
+        logging.debug("SEND_COMMAND: %s" % (self.command,))
+        worker.send_task(self)
         
 
 class RepeatedTask(Task):
@@ -119,7 +240,8 @@ class RepeatedTask(Task):
     def is_running(self):
         return len(self.workers) == self.repetitions
     
-    def complete(self, worker, result):
+    def complete(self, worker, result, elapsed=None, digest=None):
+        self.worker_done(worker, elapsed)
         for rep in self.task_workers:
             if worker in self.task_workers[rep] and rep not in self.results:
                 self.results[rep] = result
@@ -150,57 +272,764 @@ class RepeatedCommandTask(RepeatedTask, CommandTask):
         pass
 
 
+class VerifiedTask(CommandTask):
+    """A command that several workers run, whose results have to agree
+    
+    The first worker sent the task returns its full result and the others
+    only return a digest of theirs (see canonical.py), so replicas cost
+    compute but little transfer. The task is complete once `quorum` workers,
+    counting the one that sent the full result, agree on its digest. Each
+    worker runs the task at most once, so it only gets one vote.
+    
+    If every replica sent out comes back without a quorum, enough replicas
+    to make one are sent out again, up to `max_repetitions` in all. Once
+    replicas disagree, new ones return full results, since it is no longer
+    clear which result will win. After `max_repetitions` the result most
+    workers agree on is used. A replica whose worker goes away is replaced.
+    
+    When workers go away, the task makes do with those that are left (see
+    limit_replicas). If the worker that was sending the full result went
+    away and no other worker is left to run the task, one that sent the
+    digest the most workers agree on is asked for its full result, which
+    doesn't count as another vote.
+    
+    With a quorum of one, the first full result is used as it is, without
+    computing its digest, unless a digest has already come back to compare
+    it with. Raises TaskFailed if the digest of a result can't be computed.
+    """
+    
+    def __init__(self, command, data=None, repetitions=settings.REPLICAS,
+                 quorum=settings.QUORUM,
+                 max_repetitions=settings.MAX_REPLICAS, *args, **kwargs):
+        CommandTask.__init__(self, command, data, *args, **kwargs)
+        self.repetitions = repetitions
+        self.quorum = max(1, min(quorum, repetitions))
+        self.max_repetitions = max(max_repetitions, repetitions)
+        self.dispatched = 0
+        self.returned = 0
+        self.full_workers = set()
+        self.votes = collections.Counter()
+        self.payloads = {}
+        self.reported = []
+        self.accepted = None
+        self.wants_payload = False
+        self.resending = set()
+        self.resent = set()
+    
+    def handle_worker(self, worker):
+        """Send the task, asking for a digest if a full result is coming"""
+        wants_payload, self.wants_payload = self.wants_payload, False
+        if wants_payload and worker in self.leading_voters():
+            self.resending.add(worker)
+            self.resent.add(worker)
+            self.full_workers.add(worker)
+            worker.send_task(self)
+            return
+        self.dispatched += 1
+        if (wants_payload or len(self.votes) > 1 or
+            self.dispatched > self.repetitions):
+            # Replicas disagree, the full result is missing, or this is a
+            # copy of a straggler, which may be the one sending it
+            digest = False
+        else:
+            digest = bool(self.full_workers) or bool(self.payloads)
+        if not worker.send_task(self, digest=digest):
+            self.full_workers.add(worker)
+    
+    def is_running(self):
+        return self.dispatched >= self.repetitions
+    
+    def assignable(self, worker):
+        if worker not in self.workers:
+            return True
+        # Only to send the full result of the digest it voted for
+        return (self.wants_payload and worker not in self.resent and
+                worker in self.leading_voters())
+    
+    def leading_voters(self):
+        """The workers that reported the digest most workers agree on"""
+        leader, votes = self.leader()
+        return [worker for worker, reported in self.reported
+                if reported == leader]
+    
+    def leader(self):
+        """The digest most workers agree on and how many do, preferring
+        digests with a full result on ties
+        """
+        if not self.votes:
+            return None, 0
+        return max(self.votes.iteritems(),
+                   key=lambda (d, n): (n, d in self.payloads))
+    
+    def complete(self, worker, result, elapsed=None, digest=None):
+        """Count the vote of `worker` and finish the task if there's a
+        quorum
+        """
+        self.worker_done(worker, elapsed)
+        self.full_workers.discard(worker)
+        if self.state == Task.COMPLETE:
+            return
+        resent = worker in self.resending
+        self.resending.discard(worker)
+        if digest is None:
+            if self.quorum == 1 and not self.votes:
+                # Nothing to check the result against
+                self.payloads[digest] = result
+            else:
+                try:
+                    digest = canonical.digest(result)
+                except Exception:
+                    raise TaskFailed("Can't compare the results of task "
+                                     "%s:\n%s" %
+                                     (self.id, traceback.format_exc()))
+                self.payloads.setdefault(digest, result)
+        if not resent:
+            self.votes[digest] += 1
+            self.reported.append((worker, digest))
+            self.returned += 1
+        self.check()
+    
+    def check(self):
+        """Accept the result most workers agree on if there is a quorum,
+        or send the task out again if every replica has come back without
+        one
+        """
+        leader, votes = self.leader()
+        if votes >= self.quorum and leader in self.payloads:
+            self.accept(leader)
+        elif votes >= self.quorum:
+            if not self.full_workers and self.is_running():
+                self.request_payload()
+        elif self.is_running() and self.returned == self.dispatched:
+            self.redispatch(max(self.quorum - votes, 1))
+    
+    def request_payload(self, requeue=True):
+        """Have a worker that sent the leading digest send its full result
+        
+        Workers only send a digest when another is sending the full result,
+        so this is only needed when that worker went away and no other one
+        is left to take its place.
+        """
+        logging.warning("Asking a worker for the full result of task %s" %
+                        (self.id,))
+        self.wants_payload = True
+        self.state = Task.WAITING
+        if requeue:
+            self.job.requeue(self)
+    
+    def limit_replicas(self, workers):
+        """Make do with `workers`, the workers that are left
+        
+        The quorum is lowered to the number of workers that voted or still
+        can, and no more replicas are sent out than there are workers left
+        that haven't run the task, so the task completes with the votes it
+        can get instead of waiting for replicas no worker can run.
+        """
+        if self.state == Task.COMPLETE or self.job is None:
+            return
+        voters = set(worker for worker, reported in self.reported)
+        self.quorum = max(1, min(self.quorum, len(voters | set(workers))))
+        free = len([w for w in workers if w not in self.workers])
+        self.max_repetitions = min(self.max_repetitions,
+                                   self.dispatched + free)
+        self.repetitions = min(self.repetitions, self.max_repetitions)
+        if self.wants_payload or self.resending:
+            return
+        if (self.is_running() and self.returned < self.dispatched and
+            self.state == Task.WAITING):
+            self.state = Task.RUNNING
+        self.check()
+    
+    def worker_lost(self, worker, requeue=True):
+        """Send the task to another worker in place of `worker`
+        
+        The lost replica counts as returned, without a vote, and the new
+        one sends its full result if no other worker is going to. Since it
+        didn't vote, `worker` may run the task again.
+        """
+        CommandTask.worker_lost(self, worker, requeue)
+        self.workers.discard(worker)
+        self.full_workers.discard(worker)
+        if self.state == Task.COMPLETE or self.job is None:
+            return
+        if worker in self.resending:
+            self.resending.discard(worker)
+            self.request_payload(requeue)
+            return
+        logging.warning("Lost a replica of task %s; sending it to another "
+                        "worker" % (self.id,))
+        self.returned += 1
+        self.repetitions += 1
+        self.max_repetitions += 1
+        self.state = Task.WAITING
+        if requeue:
+            self.job.requeue(self)
+    
+    def redispatch(self, extra):
+        """Send the task to `extra` more workers, or give up and use the
+        result most workers agree on
+        """
+        if self.repetitions + extra > self.max_repetitions:
+            if not self.payloads:
+                # The worker sending it went away, and nobody is left to
+                # take its place
+                self.request_payload()
+                return
+            best = max(self.payloads, key=self.votes.get)
+            logging.error("No quorum for task %s after %d replicas; using "
+                          "the result %d of them agree on" %
+                          (self.id, self.returned, self.votes[best]))
+            self.accept(best)
+            return
+        logging.warning("Replicas of task %s disagree; sending it to %d more "
+                        "workers" % (self.id, extra))
+        self.repetitions += extra
+        self.state = Task.WAITING
+        for i in xrange(extra):
+            self.job.requeue(self)
+    
+    def accept(self, digest):
+        """Use the full result with the given digest"""
+        for worker, reported in self.reported:
+            if reported != digest:
+                logging.warning("Worker %r disagreed on task %s" %
+                                (worker, self.id))
+        self.result = self.payloads[digest]
+        self.accepted = digest
+        self.state = Task.COMPLETE
+    
+    def agreeing(self):
+        """The workers that reported the accepted result"""
+        return [worker for worker, reported in self.reported
+                if reported == self.accepted]
+
+
+class SpotCheckedTask(VerifiedTask):
+    """A command that usually runs on one worker, and is sometimes checked
+    
+    When the task is first handed out, `ledger` decides whether to check
+    the worker. If it does, the task also runs on a second worker that only
+    returns a digest, and on a third if they disagree. Unchecked results are
+    used as they are, and the ledger remembers who vouched for them so they
+    can be computed again if that worker turns out to be dishonest.
+    """
+    
+    def __init__(self, command, data=None, ledger=None, max_repetitions=3,
+                 *args, **kwargs):
+        VerifiedTask.__init__(self, command, data, repetitions=1, quorum=1,
+                              max_repetitions=max_repetitions, *args, **kwargs)
+        self.ledger = ledger or TrustLedger()
+    
+    def assignable(self, worker):
+        return (self.ledger.trusted(worker) and
+                VerifiedTask.assignable(self, worker))
+    
+    def handle_worker(self, worker):
+        if (self.dispatched == 0 and self.max_repetitions > 1 and
+            self.ledger.should_check(worker)):
+            self.repetitions = self.quorum = 2
+        VerifiedTask.handle_worker(self, worker)
+    
+    def accept(self, digest):
+        """Use the result and tell the ledger how the check went"""
+        VerifiedTask.accept(self, digest)
+        if len(self.reported) == 1:
+            self.ledger.vouch(self.reported[0][0], self)
+            return
+        agreed = [w for w, reported in self.reported if reported == digest]
+        disagreed = [w for w, reported in self.reported if reported != digest]
+        others = [n for d, n in self.votes.iteritems() if d != digest]
+        decided = self.votes[digest] > max(others or [0])
+        for task in self.ledger.record_check(agreed, disagreed, decided):
+            task.reopen()
+    
+    def is_final(self):
+        """Only checked results are final; others can still be reopened"""
+        return len(self.reported) > 1
+    
+    def reopen(self):
+        """Compute the task again, unless its job has already finished
+        
+        Only tasks that a single worker ran are reopened, so no results for
+        the old run can still arrive.
+        """
+        if self.job is None or self.job.finished:
+            logging.warning("Task %s was vouched for by a dishonest worker, "
+                            "but its results have already been used" %
+                            (self.id,))
+            return
+        logging.warning("Computing task %s again" % (self.id,))
+        self.repetitions = self.quorum = 1
+        self.dispatched = self.returned = 0
+        self.votes.clear()
+        self.payloads = {}
+        self.reported = []
+        self.accepted = None
+        self.wants_payload = False
+        self.resending.clear()
+        self.resent.clear()
+        self.result = None
+        self.state = Task.WAITING
+        self.job.reopen(self)
+
+
 class Job(object):
-    def __init__(self, data, TaskClass, **kwargs):
+    """Splits data into tasks and hands them out to workers
+    
+    A job is its own iterator: `next(worker)` returns the next task for
+    `worker` (see Scheduler.next for what that costs), None if every task
+    has been handed out but some are still running, and raises
+    StopIteration once they are all complete.
+    Tasks are created one chunk at a time so that the chunk size can adapt
+    to the completion times of the tasks before it, and only as workers
+    need them, so the data doesn't have to fit in memory. The job keeps the
+    result of each complete task rather than the task and its chunk.
+    
+    `speculation` are the keyword arguments for the Scheduler, which
+    decides when to run a copy of a straggling task. Once a task is
+    complete, the workers still running a copy of it are told to cancel it.
+    """
+    
+    def __init__(self, data, TaskClass, chunking=None, speculation=None,
+                 **kwargs):
         self.data = data
         self.TaskClass = TaskClass
+        self.chunking = chunking or {}
+        self.speculation = speculation or {}
         self.kwargs = kwargs
         self.result = None
+        self.chunker = None
+        self.chunks = None
+        self.scheduler = Scheduler(**self.speculation)
+        self.results = {}
+        self.created = 0
+        self.finished = False
     
     def __iter__(self):
-        dc = DataChunker(self.data)
-        tasks = [self.TaskClass(data=data, **self.kwargs) for data in dc]
-        while any([t.state == Task.WAITING for t in tasks]):
-            for t in filter(lambda t: t.state == Task.WAITING, tasks):
-                yield t
-        while any([t.state != Task.COMPLETE for t in tasks]):
-            for t in filter(lambda t: t.state != Task.COMPLETE, tasks):
-                yield t
-        self.result = self.merge_results([t.result for t in tasks])
+        return self
+    
+    def next(self, worker=None):
+        """Return the next task for `worker`"""
+        if self.finished:
+            raise StopIteration
+        if self.chunker is None:
+            self.chunker = DataChunker(self.data, **self.chunking)
+            self.chunks = iter(self.chunker)
+        task = self.scheduler.next(worker)
+        if task is None and self.chunks is not None:
+            task = self.new_task()
+            if task is not None and not task.assignable(worker):
+                # Left queued for another worker
+                task = None
+        if task is None:
+            if self.scheduler.pending() == 0:
+                self.finish()
+                raise StopIteration
+            task = self.scheduler.straggler(worker)
+            if task is not None:
+                logging.info("Task %s is straggling; running a copy" %
+                             (task.id,))
+        return task
+    
+    def new_task(self):
+        """Create a task for the next chunk, or return None if there is none"""
+        try:
+            data = self.chunks.next()
+        except StopIteration:
+            self.chunks = None
+            return None
+        task = self.TaskClass(data=data, **self.kwargs)
+        task.job = self
+        task.index = self.created
+        self.created += 1
+        self.scheduler.add(task)
+        return task
+    
+    def finish(self):
+        """Merge the results, in the order of the data, once every task is
+        complete
+        """
+        self.finished = True
+        results, self.results = self.results, {}
+        self.result = self.merge_results([results[i] for i in sorted(results)])
+        latency = self.scheduler.latencies.summary()
+        if latency['count']:
+            logging.info("%d %s tasks took %.3fs (median), %.3fs (90th "
+                         "percentile), %.3fs (99th percentile)" %
+                         (latency['count'], self.kwargs.get('command', ''),
+                          latency['p50'], latency['p90'], latency['p99']))
+    
+    def task_assigned(self, task, worker):
+        """Called when `worker` starts working on `task`"""
+        self.scheduler.assign(task, worker)
+    
+    def task_updated(self, task):
+        """Called when the state of `task` changes"""
+        self.scheduler.update(task)
+        if task.state == task.COMPLETE:
+            self.results[task.index] = task.result
+            for worker in task.workers:
+                worker.cancel_task(task)
+    
+    def requeue(self, task):
+        """Hand `task` out to one more worker before any waiting task"""
+        self.scheduler.requeue(task)
+    
+    def reopen(self, task):
+        """Queue `task`, which was complete, to be handed out again"""
+        self.results.pop(task.index, None)
+        self.scheduler.reopen(task)
+    
+    def task_done(self, task, worker, elapsed, latency=None):
+        """Called when `worker` returns a result for `task`
+        
+        `elapsed` is the time the worker spent on it, and `latency` the
+        time from sending it to getting the result back.
+        """
+        self.scheduler.release(task, worker)
+        if latency is not None:
+            self.scheduler.record(latency)
+        if self.chunker is not None and task.data:
+            self.chunker.record(len(task.data), elapsed)
+    
+    def task_cancelled(self, task, worker):
+        """Called when `worker` is told to stop running `task`, or goes
+        away while it is
+        """
+        self.scheduler.release(task, worker)
+    
+    def limit_replicas(self, workers):
+        """Called when workers went away, leaving only `workers`
         
+        New tasks get no more replicas than there are workers left, and
+        the tasks that aren't complete make do with them.
+        """
+        for key in ('repetitions', 'quorum', 'max_repetitions'):
+            if key in self.kwargs:
+                self.kwargs[key] = max(1, min(self.kwargs[key],
+                                              len(workers)))
+        for task in self.scheduler.tasks():
+            task.limit_replicas(workers)
+    
+    def task_failed(self, task, worker, error, key=None):
+        """Called when `worker` couldn't run `task` because of `error`
+        
+        `key` is set when a partition of the output of the map task stored
+        under it couldn't be fetched. Raises TaskFailed unless the job can
+        run the task again.
+        """
+        raise TaskFailed(error)
+    
     def merge_results(self, results):
         return results
 
 
-class MapReduceJob(Job):
-    def __init__(self, data, TaskClass, **kwargs):
+class MapJob(Job):
+    """The map phase of a MapReduceJob, which shuffles results as they come
+    
+    Each result is added to `output`, a PartitionedShuffle, as soon as it is
+    final, so the foreman only holds the shuffle's memory budget of map
+    output, and the rest is spilled to disk. Results that could still be
+    reopened, like unchecked spot-checked ones, are kept until the job
+    finishes. Values are grouped in the order their tasks complete rather
+    than the order of the data. The result of the job is `output`.
+    """
+    
+    def __init__(self, data, TaskClass, output, **kwargs):
         Job.__init__(self, data, TaskClass, **kwargs)
+        self.output = output
     
-    def __iter__(self):
-        mapjob = Job(self.data, self.TaskClass, command='map', **self.kwargs)
-        mapjob.merge_results = self.merge_map_results
-        for t in mapjob:
-            yield t
-        reducejob = Job(mapjob.result, self.TaskClass, command='reduce', **self.kwargs)
-        reducejob.merge_results = self.merge_reduce_results
-        for t in reducejob:
-            yield t
-        self.result = reducejob.result
-        while True:
-            yield CommandTask('disconnect')
-    
-    def merge_map_results(self, results):
-        output = {}
+    def task_updated(self, task):
+        Job.task_updated(self, task)
+        if task.state == task.COMPLETE and task.is_final():
+            self.collect(self.results.pop(task.index))
+    
+    def collect(self, data):
+        """Add the result of a task to the output"""
+        self.output.update(data)
+    
+    def merge_results(self, results):
         for data in results:
-            for key, values in data.iteritems():
-                if key not in output:
-                    output[key] = ()
-                output[key] += values
-        return output
+            self.collect(data)
+        return self.output
+
+
+class RemoteMapJob(MapJob):
+    """The map phase of a MapReduceJob whose workers shuffle the output
+    
+    Each task asks workers to split their output into the partitions of
+    `output`, a PartitionTable, and keep them under the task's ID. What
+    comes back is the digest of each partition, which replicas are checked
+    against like any result. The table records the digests and the
+    addresses of the workers that agreed on them, for reduce tasks to fetch
+    the partitions from. Where the data of each task starts in `data` and
+    how many rows it has are kept by key in `inputs`, so that it can be
+    read again if every worker holding a partition of its output goes away
+    and it has to run again (see RerunMapJob). Data that can only be read
+    once, like a generator, isn't kept, and the job fails instead.
+    """
+    
+    def __init__(self, data, TaskClass, output, **kwargs):
+        MapJob.__init__(self, data, TaskClass, output, **kwargs)
+        self.inputs = {}
+        self.position = 0
+        self.rereadable = rereadable(data)
+    
+    def new_task(self):
+        task = MapJob.new_task(self)
+        if task is not None:
+            key = task.id.hex
+            task.shuffle = {'key': key,
+                            'partitions': len(self.output.sources)}
+            if self.rereadable:
+                self.inputs[key] = (self.position, len(task.data))
+            self.position += len(task.data)
+        return task
+    
+    def task_updated(self, task):
+        Job.task_updated(self, task)
+        if task.state == task.COMPLETE:
+            holders = [worker.address for worker in task.agreeing()]
+            self.results[task.index] = (task.shuffle['key'], task.result,
+                                        holders)
+            if task.is_final():
+                self.collect(self.results.pop(task.index))
+    
+    def collect(self, entry):
+        self.output.add(entry)
+
+
+class RerunMapJob(RemoteMapJob):
+    """Runs a map task of a RemoteMapJob again once no worker can send a
+    partition of its output
+    
+    The task gets `data` and stores its output under the same `key`, and
+    the workers that agree on it replace the old holders in `output`, so
+    reduce tasks fetch from them from then on. The reduce tasks in
+    `waiting` are then handed out again. Raises TaskFailed if the output
+    changed, since the reduce tasks already fetched the old one.
+    """
+    
+    def __init__(self, data, TaskClass, output, key, **kwargs):
+        RemoteMapJob.__init__(self, data, TaskClass, output,
+                              chunking=dict(rows=len(data)), **kwargs)
+        self.key = key
+        self.waiting = []
+    
+    def new_task(self):
+        task = RemoteMapJob.new_task(self)
+        if task is not None:
+            task.shuffle['key'] = self.key
+        return task
+    
+    def task_updated(self, task):
+        Job.task_updated(self, task)
+        if task.state == task.COMPLETE:
+            digests = self.results.pop(task.index)
+            holders = [worker.address for worker in task.agreeing()]
+            if not self.output.move((self.key, digests, holders)):
+                raise TaskFailed("Map task %s gave a different result when "
+                                 "it ran again" % (self.key,))
+            waiting, self.waiting = self.waiting, []
+            for reduce_task in waiting:
+                reduce_task.job.requeue(reduce_task)
+
+
+class PartialReduceJob(MapJob):
+    """Reduces part of the map output while the map phase is still running
+    
+    Only valid when the reducer is also the combiner: the value it gives
+    for each key goes back into `output` as one more value for that key, to
+    be reduced again with the rest.
+    """
+    
+    def collect(self, data):
+        for key, value in data.iteritems():
+            self.output.add(key, value)
+
+
+class MapReduceJob(Job):
+    """A map job followed by a reduce job over its merged output
+    
+    Map output is shuffled into hash partitions as it comes in (see
+    PartitionedShuffle; `shuffle` are the keyword arguments for it). With
+    `remote_shuffle`, workers keep the partitions of their map output and
+    send each other the ones they reduce, and the foreman only keeps track
+    of where they are (see RemoteMapJob). A reduce task that can't fetch a
+    partition waits for the map task that produced it to run again (see
+    RerunMapJob), whose tasks come before any other. Otherwise, with
+    `early_reduce`,
+    workers that ask for a task once every map task has been handed out
+    reduce the largest partition in memory instead of waiting for the last
+    map tasks, and the reduce phase reads the partitions a key at a time,
+    merging whatever was spilled to disk as it goes. Once both phases are
+    complete, every call to `next()` returns a task that disconnects the
+    worker.
+    
+    `phases` maps the name of each phase that is over to how long it took
+    and how many tasks it ran; partial reduces count as map tasks.
+    """
+    
+    def __init__(self, data, TaskClass, shuffle=None, early_reduce=False,
+                 partial_reduce_bytes=settings.PARTIAL_REDUCE_BYTES,
+                 remote_shuffle=False, **kwargs):
+        Job.__init__(self, data, TaskClass, **kwargs)
+        self.shuffle = shuffle or {}
+        self.remote_shuffle = remote_shuffle
+        self.early_reduce = early_reduce and not remote_shuffle
+        self.partial_reduce_bytes = partial_reduce_bytes
+        self.output = None
+        self.mapjob = self.reducejob = None
+        self.partials = []
+        self.partial_tasks = 0
+        self.reruns = collections.OrderedDict()
+        self.phase = None
+        self.phases = collections.OrderedDict()
+        self.phase_started = None
+    
+    def next(self, worker=None):
+        """Return the next task of the current phase for `worker`"""
+        if self.phase is None and not self.finished:
+            if self.remote_shuffle:
+                self.output = PartitionTable(self.shuffle.get(
+                    'partitions', settings.SHUFFLE_PARTITIONS))
+                MapClass = RemoteMapJob
+            else:
+                self.output = PartitionedShuffle(**self.shuffle)
+                MapClass = MapJob
+            self.mapjob = MapClass(self.data, self.TaskClass, self.output,
+                                   command='map', chunking=self.chunking,
+                                   speculation=self.speculation,
+                                   **self.kwargs)
+            self.phase = self.mapjob
+            self.phase_started = time.time()
+        while self.phase is not None:
+            try:
+                if self.phase is self.mapjob:
+                    return self.next_map(worker)
+                task = self.next_rerun(worker)
+                if task is not None:
+                    return task
+                return self.phase.next(worker)
+            except StopIteration:
+                pass
+            if self.phase is self.mapjob:
+                self.end_phase('map', self.mapjob.created + self.partial_tasks)
+                command, chunking = 'reduce', self.chunking
+                if self.remote_shuffle:
+                    # A task for each partition, which its workers fetch
+                    command, chunking = 'reducepartition', dict(rows=1)
+                self.reducejob = Job(self.output, self.TaskClass,
+                                     command=command, chunking=chunking,
+                                     speculation=self.speculation,
+                                     **self.kwargs)
+                self.reducejob.merge_results = self.merge_reduce_results
+                if self.remote_shuffle:
+                    self.reducejob.task_failed = self.rerun_map
+                self.phase = self.reducejob
+            else:
+                self.end_phase('reduce', self.reducejob.created)
+                self.output.close()
+                self.result = self.reducejob.result
+                self.finished = True
+                self.phase = None
+        return CommandTask('disconnect')
+    
+    def next_map(self, worker):
+        """Return the next map or partial reduce task for `worker`
+        
+        Raises StopIteration once the map job and every partial reduce are
+        complete.
+        """
+        if not self.mapjob.finished:
+            try:
+                task = self.mapjob.next(worker)
+            except StopIteration:
+                pass
+            else:
+                if task is not None:
+                    return task
+        task = self.next_partial(worker)
+        if task is None and self.mapjob.finished and not self.partials:
+            raise StopIteration
+        return task
+    
+    def next_partial(self, worker):
+        """Return a partial reduce task for `worker`, starting a new partial
+        reduce if the map tasks still running leave it idle
+        """
+        for job in list(self.partials):
+            try:
+                task = job.next(worker)
+            except StopIteration:
+                self.partials.remove(job)
+                self.partial_tasks += job.created
+                continue
+            if task is not None:
+                return task
+        if not self.early_reduce or self.mapjob.finished:
+            return None
+        index = self.output.largest()
+        if self.output.partitions[index].size < self.partial_reduce_bytes:
+            return None
+        values = self.output.drain(index)
+        logging.debug("Reducing %d keys of partition %d early" %
+                      (len(values), index))
+        job = PartialReduceJob(((key, tuple(values[key])) for key in values),
+                               self.TaskClass, self.output, command='reduce',
+                               chunking=self.chunking,
+                               speculation=self.speculation, **self.kwargs)
+        self.partials.append(job)
+        return job.next(worker)
+    
+    def rerun_map(self, task, worker, error, key=None):
+        """Run the map task whose output is stored under `key` again, since
+        `worker` couldn't fetch a partition of it for the reduce task
+        `task`, which is handed out again once it has
+        """
+        position = self.mapjob.inputs.get(key)
+        if position is None:
+            raise TaskFailed(error)
+        logging.warning("%s; running map task %s again" % (error, key))
+        task.worker_lost(worker, requeue=False)
+        rerun = self.reruns.get(key)
+        if rerun is None:
+            data = readpairs(self.mapjob.data, *position)
+            rerun = self.reruns[key] = RerunMapJob(
+                data, self.TaskClass, self.output, key, command='map',
+                speculation=self.speculation, **self.kwargs)
+        rerun.waiting.append(task)
+    
+    def limit_replicas(self, workers):
+        """Limit the replicas of the tasks of every phase to `workers`"""
+        Job.limit_replicas(self, workers)
+        jobs = [self.mapjob, self.reducejob] + self.partials
+        for job in jobs + self.reruns.values():
+            if job is not None and not job.finished:
+                job.limit_replicas(workers)
+    
+    def next_rerun(self, worker):
+        """Return a map task that is running again for `worker`, or None"""
+        for key, job in self.reruns.items():
+            try:
+                task = job.next(worker)
+            except StopIteration:
+                del self.reruns[key]
+                continue
+            if task is not None:
+                return task
+        return None
+    
+    def end_phase(self, name, tasks):
+        """Record how long the phase that just ended took"""
+        now = time.time()
+        self.phases[name] = dict(elapsed=now - self.phase_started,
+                                 tasks=tasks)
+        self.phase_started = now
     
     def merge_reduce_results(self, results):
         output = {}
         for data in results:
             for key, value in data.iteritems():
                 output[key] = value
-        return output
\ No newline at end of file
+        return output
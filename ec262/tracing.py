@@ -0,0 +1,198 @@
+import json
+import bisect
+import pstats
+import collections
+import settings
+
+# The spans of a task, in the order they happen. The foreman measures
+# `dispatch` (choosing the task for a worker that asked for one), `send`
+# (pickling and queueing it), `receive` (unpickling the result) and `merge`
+# (handing it to the job); the worker measures `unpickle`, `fetch` (getting
+# the partitions of a reduce from other workers), `queue` (waiting for a
+# process), `run` (the user functions) and `pickle` (pickling the message
+# with the result, which is why workers send their spans after it).
+# `latency` is the time from sending the task to getting the result back.
+SPANS = ('dispatch', 'send', 'unpickle', 'fetch', 'queue', 'run', 'pickle',
+         'receive', 'merge', 'latency')
+
+
+class Tracer(object):
+    """Collects the timing spans of every task of a job
+
+    Each time a worker returns a result, `record` is called with the spans
+    measured for that task on that worker, which are added up per span and
+    passed on to each of `exporters`. An exporter is any object with
+    `export(record)` and `close()` methods, like JSONLinesExporter and
+    PrometheusExporter. Recording only adds a few numbers per task, so it
+    can be left on.
+    """
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self.results = collections.Counter()
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.maxima = collections.defaultdict(float)
+
+    def record(self, task, worker, spans):
+        """Record the `spans` (in seconds) of `task` on `worker`"""
+        command = getattr(task, 'command', None)
+        self.results[command] += 1
+        for name, seconds in spans.iteritems():
+            if seconds is None:
+                continue
+            self.totals[name] += seconds
+            self.counts[name] += 1
+            if seconds > self.maxima[name]:
+                self.maxima[name] = seconds
+        if self.exporters:
+            record = {
+                'task': task.id.hex,
+                'index': task.index,
+                'command': command,
+                'worker': "%s:%s" % tuple(worker.address),
+                'spans': dict((name, seconds) for name, seconds
+                              in spans.iteritems() if seconds is not None),
+            }
+            for exporter in self.exporters:
+                exporter.export(record)
+
+    def summary(self):
+        """The number of results received per command, and the total, mean
+        and maximum time of each span
+        """
+        spans = collections.OrderedDict()
+        for name in sorted(self.counts, key=_span_order):
+            count = self.counts[name]
+            spans[name] = dict(total=self.totals[name], count=count,
+                               mean=self.totals[name] / count,
+                               max=self.maxima[name])
+        return dict(results=dict(self.results), spans=spans)
+
+    def close(self):
+        for exporter in self.exporters:
+            exporter.close()
+
+def _span_order(name):
+    return SPANS.index(name) if name in SPANS else len(SPANS)
+
+
+class JobProfile(object):
+    """The profile of the user functions of a job, merged from the cProfile
+    stats that workers return with the result of each task
+
+    `stats` is a pstats.Stats, to sort and print the hot spots of the whole
+    job, such as the user's functions and the sandbox's import hook, or None
+    until a task has been profiled.
+    """
+
+    def __init__(self):
+        self.stats = None
+        self.tasks = 0
+
+    def add(self, stats):
+        """Merge the stats of a task, a dictionary in the pstats format"""
+        if self.stats is None:
+            self.stats = pstats.Stats(_Profiled(stats))
+        else:
+            self.stats.add(_Profiled(stats))
+        self.tasks += 1
+
+    def dump(self, path):
+        """Save the profile where pstats and other tools can load it"""
+        if self.stats is not None:
+            self.stats.dump_stats(path)
+
+
+class _Profiled(object):
+    """Lets pstats load stats that were already collected"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class JSONLinesExporter(object):
+    """Writes each task's record as a line of JSON to `out`, a file or the
+    path of one
+    """
+
+    def __init__(self, out):
+        self.own = isinstance(out, basestring)
+        self.out = open(out, 'a') if self.own else out
+
+    def export(self, record):
+        self.out.write(json.dumps(record, sort_keys=True))
+        self.out.write('\n')
+
+    def close(self):
+        if self.own:
+            self.out.close()
+        else:
+            self.out.flush()
+
+
+class PrometheusExporter(object):
+    """Keeps a histogram of each span per command, in the Prometheus text
+    exposition format
+
+    `render()` returns the text at any time. If `path` is given, it is
+    written there when the job is done, e.g. for node_exporter's textfile
+    collector.
+    """
+
+    def __init__(self, path=None, buckets=settings.TRACE_BUCKETS):
+        self.path = path
+        self.buckets = tuple(buckets)
+        self.tasks = collections.Counter()
+        # (span, command) -> [count per bucket, count, sum]
+        self.histograms = collections.OrderedDict()
+
+    def export(self, record):
+        command = record['command']
+        self.tasks[command] += 1
+        for name, seconds in record['spans'].iteritems():
+            key = (name, command)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def render(self):
+        lines = ["# HELP ec262_tasks_total Task results received.",
+                 "# TYPE ec262_tasks_total counter"]
+        for command, count in sorted(self.tasks.iteritems()):
+            lines.append('ec262_tasks_total{command="%s"} %d' %
+                         (command, count))
+        lines.append("# HELP ec262_task_span_seconds Time tasks spent in "
+                     "each span.")
+        lines.append("# TYPE ec262_task_span_seconds histogram")
+        keys = sorted(self.histograms,
+                      key=lambda key: (_span_order(key[0]),) + key)
+        for name, command in keys:
+            counts, count, total = self.histograms[(name, command)]
+            labels = 'span="%s",command="%s"' % (name, command)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('ec262_task_span_seconds_bucket{%s,le="%g"} %d'
+                             % (labels, bound, cumulative))
+            lines.append('ec262_task_span_seconds_bucket{%s,le="+Inf"} %d' %
+                         (labels, count))
+            lines.append('ec262_task_span_seconds_sum{%s} %.6f' %
+                         (labels, total))
+            lines.append('ec262_task_span_seconds_count{%s} %d' %
+                         (labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                f.write(self.render())
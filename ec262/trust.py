@@ -0,0 +1,78 @@
+import random
+import collections
+import settings
+
+class TrustLedger(object):
+    """Keeps score of how far each worker can be trusted during a job
+
+    Tasks are checked by running them again on another worker with
+    probability `rate(worker)`. A worker starts out checked at `rate`; every
+    check it loses (the other workers agree on a different result) is a
+    strike, and every check that couldn't be decided is a dispute. Each of
+    those multiplies its rate by `escalation`. A worker with `strikes`
+    strikes is taken to be dishonest: it gets no more tasks, and the results
+    only it vouched for are handed back to be computed again.
+    """
+
+    def __init__(self, rate=settings.SPOT_CHECK_RATE,
+                 escalation=settings.SPOT_CHECK_ESCALATION,
+                 strikes=settings.SPOT_CHECK_STRIKES, seed=None):
+        self.base_rate = rate
+        self.escalation = escalation
+        self.max_strikes = strikes
+        self.random = random.Random(seed)
+        self.checks = collections.Counter()
+        self.agreed = collections.Counter()
+        self.strikes = collections.Counter()
+        self.disputes = collections.Counter()
+        self.dishonest = set()
+        self.vouched = collections.defaultdict(list)
+
+    def rate(self, worker):
+        """The probability that a task `worker` runs is checked"""
+        if self.base_rate <= 0:
+            return 0.0
+        suspicion = self.strikes[worker] + self.disputes[worker]
+        return min(1.0, self.base_rate * self.escalation ** suspicion)
+
+    def should_check(self, worker):
+        """Decide whether to check a task that `worker` runs"""
+        return self.random.random() < self.rate(worker)
+
+    def score(self, worker):
+        """The fraction of checks `worker` passed, starting from 1/2"""
+        return (self.agreed[worker] + 1.0) / (self.checks[worker] + 2.0)
+
+    def trusted(self, worker):
+        return worker not in self.dishonest
+
+    def vouch(self, worker, task):
+        """Record that `task`'s result was accepted on `worker`'s word"""
+        self.vouched[worker].append(task)
+
+    def record_check(self, agreed, disagreed, decided=True):
+        """Record the outcome of a check
+
+        `agreed` are the workers that reported the accepted result and
+        `disagreed` the others. If the check wasn't `decided` by a majority,
+        every worker involved gets a dispute instead. Returns the tasks to
+        compute again because of workers found to be dishonest.
+        """
+        for worker in agreed:
+            self.checks[worker] += 1
+            if decided:
+                self.agreed[worker] += 1
+            elif disagreed:
+                self.disputes[worker] += 1
+        invalid = []
+        for worker in disagreed:
+            self.checks[worker] += 1
+            if not decided:
+                self.disputes[worker] += 1
+                continue
+            self.strikes[worker] += 1
+            if (self.strikes[worker] >= self.max_strikes and
+                worker not in self.dishonest):
+                self.dishonest.add(worker)
+                invalid.extend(self.vouched.pop(worker, ()))
+        return invalid
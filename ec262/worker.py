@@ -1,79 +1,447 @@
 import asyncore, asynchat
+import time
 import socket
 import logging
+import itertools
 from protocol import Protocol
-from sandbox import unfreeze_and_sandbox_function
+from engine import Engine
+from sandbox import code_hash
+from shuffle import ShuffleBuffer
+import canonical
+import eventloop
 import settings
 
 class Server(asyncore.dispatcher):
-    def __init__(self):
+    def __init__(self, processes=None):
         asyncore.dispatcher.__init__(self)
+        self.processes = processes
+        self.engine = None
+        self.partitions = {}
     
     def run(self, port=settings.DEFAULT_PORT):
+        # Start the pool before listening so its processes don't inherit
+        # the listening socket
+        self.engine = Engine(self.processes)
         logging.debug("Starting server on %d" % (port,))
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.bind(("", port))
-        self.listen(1)
+        self.listen(settings.LISTEN_BACKLOG)
         try:
-            asyncore.loop()
+            eventloop.loop()
         except:
-            self.close_all()
+            self.engine.close()
+            asyncore.close_all()
             raise
         logging.debug("Shutting down server")
     
     def handle_accept(self):
         """When connected to, create a new Worker"""
-        conn, addr = self.accept()
+        pair = self.accept()
+        if pair is None:
+            return
+        conn, addr = pair
         logging.debug("Accepting job from %s:%s" % addr)
-        Worker(conn)
+        Worker(conn, self.engine, self.partitions)
 
 class Worker(Protocol):
-    def __init__(self, conn):
+    """Runs the tasks of a foreman, or serves map output to another worker
+    
+    `partitions` is shared by every connection to the server: it maps the
+    key of each map task run for a shuffle between workers to the
+    partitions of its output. They are kept until the connection of the
+    foreman that sent the task closes.
+    """
+    
+    def __init__(self, conn, engine, partitions=None):
         Protocol.__init__(self, conn)
-        self.mapfn = self.reducefn = None
+        self.engine = engine
+        self.partitions = {} if partitions is None else partitions
+        self.stored = set()
+        self.peers = {}
+        self.functions = {}
+        self.tagged = False
+        self.batch = ()
+        self.trace = False
+        self.traces = {}
+        self.profile = False
+        self.running = set()
+        self.cancelled = set()
         
-        self.register_command('mapfn', self.set_mapfn)
-        self.register_command('reducefn', self.set_reducefn)
+        self.register_command('mapfn', self.set_function)
+        self.register_command('reducefn', self.set_function)
+        self.register_command('combinefn', self.set_function)
+        self.register_command('fnoffer', self.offer_functions)
         self.register_command('map', self.call_mapfn)
         self.register_command('reduce', self.call_reducefn)
+        self.register_command('reducepartition', self.call_reducepartition)
+        self.register_command('fetch', self.serve_partition)
+        self.register_command('cancel', self.cancel_task)
+        self.register_command('configure', self.configure)
         
-        self.send_command('ready')
+        self.send_command('ready', {
+            'version': settings.VERSION,
+            'pipeline': True,
+            'digest': True,
+            'fncache': True,
+            'processes': engine.processes,
+            'shuffle': True,
+            'cancel': True,
+            'batch': True,
+            'trace': True,
+            'profile': True,
+            'wire': self.wire_options(),
+        })
     
     def handle_close(self):
         """Override default close handler"""
         logging.debug('Worker disconnect')
+        for key in self.stored:
+            self.partitions.pop(key, None)
+        self.stored.clear()
+        for peer in self.peers.values():
+            peer.close()
+        self.peers.clear()
         self.close()
     
-    def set_mapfn(self, command, mapfn):
-        """Set the map function using the given code"""
-        self.mapfn = unfreeze_and_sandbox_function(mapfn, 'mapfn')
-
-    def set_reducefn(self, command, reducefn):
-        """Set the reduce function using the given code"""
-        self.reducefn = unfreeze_and_sandbox_function(reducefn, 'reducefn')
+    def configure(self, command, options):
+        """Use the options the foreman picked from those sent with `ready`
+        
+        With `pipeline` set, tasks and their results are tagged with an ID
+        so that the foreman can send more tasks before results come back.
+        With `wire` set, everything after this command uses that format.
+        `batch` lists the functions to call once per chunk. With `trace`
+        set, results carry the time spent on each part of their task, and
+        with `profile` set, the profile of the functions.
+        """
+        self.tagged = options.get('pipeline', False)
+        self.batch = tuple(options.get('batch', ()))
+        self.trace = options.get('trace', False)
+        self.profile = options.get('profile', False)
+        if options.get('wire'):
+            self.set_wire_format(**options['wire'])
+    
+    def set_function(self, command, frozen_fn):
+        """Set the map, reduce or combine function using the given code
+        
+        The code is unfrozen and sandboxed by the engine when a task needs
+        it, in the process that runs the task, and kept by hash so that
+        later connections can skip sending it.
+        """
+        digest = code_hash(frozen_fn)
+        self.engine.code.put(digest, frozen_fn)
+        self.functions[command] = (digest, frozen_fn)
+    
+    def offer_functions(self, command, offer):
+        """Use the cached code for the functions offered by hash
+        
+        `offer` maps each function name to the hash of its code. The reply
+        lists the names of those that aren't cached, which the foreman then
+        sends with `set_function` before any task.
+        """
+        wanted = []
+        for name, digest in offer.iteritems():
+            frozen_fn = self.engine.code.get(digest)
+            if frozen_fn is None:
+                wanted.append(name)
+            else:
+                self.functions[name] = (digest, frozen_fn)
+        self.send_command('fnwant', wanted)
 
     def call_mapfn(self, command, data):
-        """Run the map function on the given key-value pairs"""
+        """Run the map function on the given key-value pairs
+        
+        If the foreman asks for a shuffle between workers, the output is
+        split into partitions that are kept to serve to reduce workers, and
+        only their digests are sent back.
+        """
+        shuffle = data.get('shuffle') if self.tagged else None
+        tag, digest, data = self.untag(data)
         logging.info("Mapping %s..." % (repr(data)[:30]))
-        results = {}
-        for row in data:
-            key, value = row
-            output = self.mapfn(key, value)
-            for key, value in output:
-                if key not in results:
-                    results[key] = ()
-                results[key] += (value,)
-        self.send_command('taskcomplete', results)
-       
+        if shuffle:
+            self.run_shuffled_map(tag, data, shuffle)
+        else:
+            self.run_task('map', tag, data, digest)
+    
+    def run_shuffled_map(self, tag, data, shuffle):
+        """Run a map task and keep the partitions of its output"""
+        key = shuffle['key']
+        def callback(results, stats):
+            if not self.finish_task(tag):
+                return
+            parts, digests = results
+            self.partitions[key] = parts
+            self.stored.add(key)
+            self.complete_task(tag, digests, stats)
+        def errback(error):
+            self.fail_task(tag, error)
+        self.engine.submit('map', self.functions, data, callback, errback,
+                           partitions=shuffle['partitions'],
+                           batch=self.batch, profile=self.profile)
 
     def call_reducefn(self, command, data):
         """Run the reduce function on the given key-values pairs"""
+        tag, digest, data = self.untag(data)
         logging.info("Reducing %s" % repr(data)[:30])
-        results = {}
-        for row in data:
-            key, values = row
-            output = self.reducefn(key, values)
-            for key, value in output:
-                results[key] = value
-        self.send_command('taskcomplete', results)
\ No newline at end of file
+        self.run_task('reduce', tag, data, digest)
+    
+    def call_reducepartition(self, command, data):
+        """Fetch the partitions described by the given rows from the
+        workers that hold them, then reduce them
+        
+        Each row is a partition number and the (key, digest, holders) of
+        each piece of it. If no holder can send a piece, the foreman is told
+        which map task's output it belongs to, so it can run that again.
+        """
+        tag, digest, rows = self.untag(data)
+        logging.info("Fetching partitions %s" %
+                     ([index for index, sources in rows],))
+        start = time.time()
+        def callback(data):
+            if tag in self.traces:
+                self.traces[tag]['fetch'] = time.time() - start
+            self.run_task('reduce', tag, data, digest)
+        def errback(key, error):
+            self.report_failure(tag, error, key)
+        PartitionFetch(self, rows, callback, errback).start()
+    
+    def serve_partition(self, command, request):
+        """Send a partition of a map task's output to another worker"""
+        parts = self.partitions.get(request['key'])
+        data = None
+        if parts is not None:
+            data = parts.get(request['partition'], {})
+        self.send_command('partition', {'id': request['id'], 'data': data})
+    
+    def peer(self, address):
+        """The connection to the worker at `address`, opened if needed"""
+        peer = self.peers.get(address)
+        if peer is None or not (peer.connected or peer.connecting):
+            peer = self.peers[address] = PeerConnection(address)
+        return peer
+    
+    def untag(self, data):
+        """Split the data sent with a task into its tag, digest flag and
+        payload
+        
+        The foreman sets `digest` when it only needs the digest of the
+        result, to check it against another worker's.
+        """
+        if self.tagged:
+            self.running.add(data['id'])
+            if self.trace:
+                self.traces[data['id']] = {'unpickle': self.decode_time}
+            return data['id'], data.get('digest', False), data['data']
+        return None, False, data
+    
+    def cancel_task(self, command, data):
+        """Don't send the result of a task that another worker completed
+        
+        Nothing is stopped: the pool can't interrupt a task it was handed,
+        so a task already submitted to the engine, even one still queued
+        there, is computed to the end and only its result is dropped. A
+        reduce task still fetching partitions is dropped before it runs.
+        """
+        if data['id'] in self.running:
+            self.cancelled.add(data['id'])
+    
+    def finish_task(self, tag):
+        """Forget a task that is done; returns whether it wasn't cancelled"""
+        self.running.discard(tag)
+        if tag in self.cancelled:
+            self.cancelled.discard(tag)
+            self.traces.pop(tag, None)
+            logging.info("Task %s was cancelled" % (tag,))
+            return False
+        return True
+    
+    def run_task(self, command, tag, data, digest=False):
+        """Queue a task with the engine, which runs it when it can"""
+        if tag in self.cancelled:
+            self.finish_task(tag)
+            return
+        def callback(results, stats):
+            if self.finish_task(tag):
+                self.complete_task(tag, results, stats, digest)
+        def errback(error):
+            self.fail_task(tag, error)
+        self.engine.submit(command, self.functions, data, callback,
+                           errback, digest, batch=self.batch,
+                           profile=self.profile)
+    
+    def complete_task(self, tag, results, stats, digest=False):
+        """Send the results of a task, or their digest, back to the foreman
+        
+        Traced tasks then send their spans (see tracing.py) with
+        `taskspans`, so that they include the time it took to pickle the
+        message with the results.
+        """
+        if not self.tagged:
+            self.send_command('taskcomplete', results)
+            return
+        message = dict(stats, id=tag)
+        queue = message.pop('queue', None)
+        message['digest' if digest else 'result'] = results
+        self.send_command('taskcomplete', message)
+        spans = self.traces.pop(tag, None)
+        if spans is not None:
+            spans['queue'] = queue
+            spans['run'] = stats['elapsed']
+            spans['pickle'] = self.encode_time
+            self.send_command('taskspans', {'id': tag, 'spans': spans})
+    
+    def fail_task(self, tag, error):
+        """Report a task whose user function raised an exception
+        
+        `error` is the traceback, which the foreman fails the job with, as
+        the local backend does. A foreman that doesn't tag tasks can't be
+        told which one failed, so its connection is dropped instead.
+        """
+        if not self.tagged:
+            logging.error("Task failed:\n%s" % (error,))
+            self.handle_close()
+            return
+        self.report_failure(tag, error)
+    
+    def report_failure(self, tag, error, key=None):
+        """Tell the foreman that a task failed, and keep the connection
+        
+        `key` is set when the task couldn't fetch the output of the map task
+        stored under it.
+        """
+        logging.warning("Task %s failed: %s" % (tag, error))
+        self.traces.pop(tag, None)
+        if self.finish_task(tag):
+            self.send_command('taskfailed', {'id': tag, 'error': error,
+                                             'key': key})
+
+
+class PartitionFetch(object):
+    """Gathers the pieces of some partitions for a reduce task
+    
+    Each piece is read from this worker's own map output if it has it, and
+    otherwise fetched from the first of its holders that sends data with
+    the right digest, so a worker can't tamper with what it serves. The
+    pieces are merged in the order they are listed, whatever order they
+    arrive in, so every replica of the task reduces the same data. Then
+    `callback` is called with the merged (key, values) pairs, or, if no
+    holder sends a piece, `errback` with the key it is stored under and why.
+    """
+    
+    def __init__(self, worker, rows, callback, errback):
+        self.worker = worker
+        self.callback = callback
+        self.errback = errback
+        self.pieces = []
+        for index, sources in rows:
+            for key, digest, holders in sources:
+                self.pieces.append((index, key, digest, list(holders)))
+        self.received = [None] * len(self.pieces)
+        self.outstanding = len(self.pieces)
+        self.failed = False
+    
+    def start(self):
+        for i, (index, key, digest, holders) in enumerate(self.pieces):
+            parts = self.worker.partitions.get(key)
+            if parts is not None and index in parts:
+                self.done(i, parts[index])
+            else:
+                self.request(i)
+        if not self.pieces:
+            self.finish()
+    
+    def request(self, i):
+        """Ask the next holder of piece `i` for it"""
+        index, key, digest, holders = self.pieces[i]
+        if not holders:
+            self.failed = True
+            self.errback(key, "No worker could send partition %d of %s" %
+                         (index, key))
+            return
+        address = tuple(holders.pop(0))
+        self.worker.peer(address).fetch(
+            key, index, lambda data: self.check(i, address, data))
+    
+    def check(self, i, address, data):
+        if self.failed:
+            return
+        index, key, digest, holders = self.pieces[i]
+        if data is None:
+            logging.warning("Worker %s:%d couldn't send partition %d of %s" %
+                            (address[0], address[1], index, key))
+        elif canonical.digest(data) != digest:
+            logging.warning("Worker %s:%d sent a bad copy of partition %d "
+                            "of %s" % (address[0], address[1], index, key))
+        else:
+            self.done(i, data)
+            return
+        self.request(i)
+    
+    def done(self, i, data):
+        self.received[i] = data
+        self.outstanding -= 1
+        if self.outstanding == 0:
+            self.finish()
+    
+    def finish(self):
+        output = ShuffleBuffer()
+        for data in self.received:
+            output.update(data)
+        self.received = []
+        self.callback(output.materialize().items())
+
+
+class PeerConnection(Protocol):
+    """A connection to another worker's server to fetch partitions from
+    
+    Requests are queued until the worker is ready, and every request still
+    waiting when the connection closes gets None, so it can be sent to
+    another holder.
+    """
+    
+    def __init__(self, address):
+        Protocol.__init__(self)
+        self.address = address
+        self.ready = False
+        self.requests = itertools.count()
+        self.queued = []
+        self.callbacks = {}
+        self.register_command('ready', self.start)
+        self.register_command('partition', self.received)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+    
+    def fetch(self, key, index, callback):
+        """Ask for partition `index` of the map output stored under `key`"""
+        request = {'id': self.requests.next(), 'key': key, 'partition': index}
+        self.callbacks[request['id']] = callback
+        if self.ready:
+            self.send_command('fetch', request)
+        else:
+            self.queued.append(request)
+    
+    def start(self, command, options):
+        wire = self.choose_wire_format((options or {}).get('wire'),
+                                       settings.COMPRESS_THRESHOLD)
+        if wire:
+            self.send_command('configure', {'wire': wire})
+            self.set_wire_format(**wire)
+        self.ready = True
+        queued, self.queued = self.queued, []
+        for request in queued:
+            self.send_command('fetch', request)
+    
+    def received(self, command, reply):
+        callback = self.callbacks.pop(reply['id'], None)
+        if callback is not None:
+            callback(reply['data'])
+    
+    def handle_error(self):
+        logging.warning("Error talking to worker %s:%d" % self.address)
+        self.handle_close()
+    
+    def handle_close(self):
+        self.close()
+        callbacks, self.callbacks = self.callbacks, {}
+        for callback in callbacks.values():
+            callback(None)
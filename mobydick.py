@@ -1,11 +1,12 @@
 #!/usr/bin/env python
-from ec262 import mapper, reducer, run_job
+from ec262 import mapper, reducer, combiner, run_job, LineFileSource
 
 @mapper
 def mapfn(k, v):
     for w in v.split():
         yield w, 1
 
+@combiner
 @reducer
 def reducefn(k, vs):
     result = sum(vs)
@@ -13,7 +14,6 @@ def reducefn(k, vs):
 
 
 if __name__ == '__main__':
-    f = open('mobydick.txt', 'r')
-    datasource = dict(enumerate(f.readlines()))
+    datasource = LineFileSource('mobydick.txt')
     results = run_job(datasource)
     print results
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""Jobs whose functions fail, or whose workers do, on a cluster of workers
+
+Run with `python -m unittest discover tests` from the top of the tree.
+"""
+import time
+import logging
+import threading
+import unittest
+import multiprocessing
+from ec262.foreman import Foreman
+from ec262.task import TaskFailed
+from ec262.worker import Server
+from benchmarks.cluster import free_port, listening
+
+def serve(port):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    Server(1).run(port)
+
+def raising_mapfn(key, value):
+    if key == 17:
+        raise ValueError("bad row %d" % key)
+    yield value % 3, 1
+
+def slow_mapfn(key, value):
+    import time
+    time.sleep(0.05)
+    yield value % 3, 1
+
+def reducefn(key, values):
+    yield key, sum(values)
+
+def run_job(workers, results, mapfn, replicas, rows):
+    logging.getLogger().setLevel(logging.CRITICAL)
+    foreman = Foreman()
+    foreman.mapfn, foreman.reducefn = mapfn, reducefn
+    foreman.datasource = dict((i, i) for i in xrange(rows))
+    foreman.replication = dict(repetitions=replicas, quorum=replicas,
+                               max_repetitions=replicas)
+    foreman.chunking = dict(rows=2)
+    try:
+        results.put(foreman.run(workers))
+    except TaskFailed, e:
+        results.put(e)
+
+
+class ClusterTest(unittest.TestCase):
+    size = 3
+
+    def setUp(self):
+        self.servers = []
+        self.workers = []
+        for i in xrange(self.size):
+            port = free_port()
+            process = multiprocessing.Process(target=serve, args=(port,))
+            process.start()
+            self.servers.append(process)
+            self.workers.append(("127.0.0.1", port))
+        deadline = time.time() + 10
+        while not all(listening(address) for address in self.workers):
+            self.assertLess(time.time(), deadline, "Workers didn't start")
+            time.sleep(0.05)
+
+    def tearDown(self):
+        for process in self.servers:
+            process.terminate()
+            process.join()
+
+    def run_job(self, mapfn, replicas, rows=30):
+        """Run a job on the cluster and return its result or TaskFailed"""
+        results = multiprocessing.Queue()
+        foreman = multiprocessing.Process(
+            target=run_job,
+            args=(self.workers, results, mapfn, replicas, rows))
+        foreman.start()
+        foreman.join(30)
+        if foreman.is_alive():
+            foreman.terminate()
+            self.fail("The job didn't finish")
+        return results.get(timeout=1)
+
+
+class FailingFunctionTest(ClusterTest):
+    def test_raising_function_fails_the_job_with_its_traceback(self):
+        for replicas in (1, self.size):
+            error = self.run_job(raising_mapfn, replicas)
+            self.assertIsInstance(error, TaskFailed)
+            self.assertIn("ValueError: bad row 17", str(error))
+
+
+class LostWorkerTest(ClusterTest):
+    def test_job_finishes_without_a_worker_it_needed_for_every_quorum(self):
+        # Every task runs on every worker, so the replicas of the lost one
+        # can't be replaced and the quorum has to make do without it
+        timer = threading.Timer(1, self.servers[0].terminate)
+        timer.start()
+        try:
+            result = self.run_job(slow_mapfn, self.size, rows=60)
+        finally:
+            timer.cancel()
+        self.assertEqual(result, {0: 20, 1: 20, 2: 20})
+
+
+if __name__ == '__main__':
+    unittest.main()
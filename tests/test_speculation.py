@@ -0,0 +1,86 @@
+"""A job with a worker that never returns a result still finishes
+
+Run with `python -m unittest discover tests` from the top of the tree.
+"""
+import time
+import logging
+import unittest
+import multiprocessing
+from ec262.foreman import Foreman
+from ec262.worker import Server, Worker
+from benchmarks.cluster import free_port, listening
+
+class SilentWorker(Worker):
+    """Takes tasks and never runs them, like a worker that hung"""
+
+    def run_task(self, command, tag, data, digest=False):
+        pass
+
+
+class SilentServer(Server):
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            SilentWorker(pair[0], self.engine, self.partitions)
+
+
+def serve(ServerClass, port):
+    logging.getLogger().setLevel(logging.ERROR)
+    ServerClass(1).run(port)
+
+def mapfn(key, value):
+    import time
+    time.sleep(0.05)
+    yield value % 3, 1
+
+def reducefn(key, values):
+    yield key, sum(values)
+
+def run_job(workers, results):
+    foreman = Foreman()
+    foreman.mapfn, foreman.reducefn = mapfn, reducefn
+    foreman.datasource = dict((i, i) for i in xrange(30))
+    foreman.replication = dict(repetitions=1, quorum=1, max_repetitions=1)
+    foreman.chunking = dict(rows=2)
+    foreman.speculation = dict(multiple=10, copies=1, min_samples=1)
+    results.put(foreman.run(workers))
+
+
+class SilentWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+        self.workers = []
+        for ServerClass in (Server, Server, SilentServer):
+            port = free_port()
+            process = multiprocessing.Process(target=serve,
+                                              args=(ServerClass, port))
+            process.start()
+            self.servers.append(process)
+            self.workers.append(("127.0.0.1", port))
+        deadline = time.time() + 10
+        while not all(listening(address) for address in self.workers):
+            self.assertLess(time.time(), deadline, "Workers didn't start")
+            time.sleep(0.05)
+
+    def tearDown(self):
+        for process in self.servers:
+            process.terminate()
+            process.join()
+
+    def test_copies_of_silent_tasks_finish_the_job(self):
+        # The other workers run out of tasks before the silent worker's
+        # become stragglers, so only the foreman's tick can start copies
+        results = multiprocessing.Queue()
+        foreman = multiprocessing.Process(target=run_job,
+                                          args=(self.workers, results))
+        foreman.start()
+        foreman.join(30)
+        if foreman.is_alive():
+            foreman.terminate()
+            self.fail("The job is still waiting for the silent worker")
+        self.assertEqual(foreman.exitcode, 0)
+        self.assertEqual(results.get(timeout=1), {0: 10, 1: 10, 2: 10})
+
+
+if __name__ == '__main__':
+    unittest.main()
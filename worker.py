@@ -7,6 +7,7 @@ import optparse
 if __name__ == '__main__':
     parser = optparse.OptionParser(usage="%prog [options]", version="%%prog %s"%VERSION)
     parser.add_option("-P", "--port", dest="port", type="int", default=DEFAULT_PORT, help="port")
+    parser.add_option("-j", "--processes", dest="processes", type="int", default=None, help="number of processes running tasks (defaults to one per core)")
     parser.add_option("-v", "--verbose", dest="verbose", action="store_true")
     parser.add_option("-V", "--loud", dest="loud", action="store_true")
 
@@ -17,4 +18,4 @@ if __name__ == '__main__':
     if options.loud:
         logging.basicConfig(level=logging.DEBUG)
     
-    run_worker(options.port)
\ No newline at end of file
+    run_worker(options.port, options.processes)
\ No newline at end of file